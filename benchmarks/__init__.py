@@ -0,0 +1 @@
+"""Офлайн-бенчмарки DocuMind. Запуск з кореня репозиторію: `python -m benchmarks.<назва>`."""
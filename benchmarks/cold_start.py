@@ -0,0 +1,108 @@
+"""Відтворюваний замір холодного старту.
+
+Кожен прогін — окремий інтерпретатор: вимірюється час `import main` і час до
+першої відповіді на /start через `telegram_webhook`. Telegram підмінено
+локальним транспортом, тож мережа не потрібна; решта шляху (секрети, фабрики
+клієнтів, ініціалізація бота, runtime-loop) — справжня.
+
+    python -m benchmarks.cold_start --runs 10
+    python -m benchmarks.cold_start --importtime   # найдорожчі модулі імпорту
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+START_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1, "date": 0, "text": "/start",
+        "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Bench"},
+    },
+}
+HEAVY_MODULES = ("google.cloud.vision", "google.cloud.firestore", "google.cloud.secretmanager", "google.generativeai")
+
+
+class FakeHttpRequest:
+    method = "POST"
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def get_json(self, force=False):
+        return self._payload
+
+
+def child():
+    start = time.perf_counter()
+    import main
+    import_done = time.perf_counter()
+
+    from benchmarks.fakes import OfflineTelegramRequest
+    main.TelegramRequest = lambda **kwargs: OfflineTelegramRequest()
+
+    response = main.telegram_webhook(FakeHttpRequest(START_UPDATE))
+    done = time.perf_counter()
+    print(json.dumps({
+        "import_ms": (import_done - start) * 1000,
+        "first_response_ms": (done - import_done) * 1000,
+        "total_ms": (done - start) * 1000,
+        "status": response[1],
+        "clients": main.clients.initialized(),
+        "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+    }))
+
+
+def child_env():
+    env = dict(os.environ)
+    env.setdefault("TELEGRAM_BOT_TOKEN", "123456:cold-start-bench")
+    env.setdefault("GEMINI_API_KEY", "cold-start-bench")
+    return env
+
+
+def run(runs):
+    results = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-m", "benchmarks.cold_start", "--child"],
+            capture_output=True, text=True, env=child_env(), check=True,
+        )
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    for key in ("import_ms", "first_response_ms", "total_ms"):
+        values = [r[key] for r in results]
+        print(f"{key:<18} median={statistics.median(values):8.1f}ms min={min(values):8.1f}ms max={max(values):8.1f}ms")
+    last = results[-1]
+    print(f"status={last['status']} clients={last['clients']} heavy_modules={last['heavy_modules'] or '-'}")
+
+
+def importtime(top):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                         capture_output=True, text=True, env=child_env())
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), name.strip()))
+    for cumulative_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:8.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--importtime", action="store_true")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+    elif args.importtime:
+        importtime(args.top)
+    else:
+        run(args.runs)
@@ -0,0 +1,259 @@
+"""Фейкові бекенди для офлайн-бенчмарків (без мережі та облікових даних).
+
+Кожен фейк має налаштовувану латентність і частку помилок та рахує виклики.
+Клієнти Vision, Firestore і Gemini синхронні, як і справжні SDK: main.py
+викликає їх у пулах потоків, тож фейки блокують потік через time.sleep.
+"""
+import base64
+import copy
+import itertools
+import json
+import random
+import threading
+import time
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+from telegram.request import BaseRequest
+
+FAKE_BOT_USER = {"id": 1, "is_bot": True, "first_name": "DocuMind", "username": "documind_bot"}
+# Справжній JPEG 8x8: до нього дописується шлях файлу, тож кожен файл має унікальний SHA-256
+FAKE_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkzODdASFxOQERXRTc4UG1RV19iZ2hnPk1x"
+    "eXBkeFxlZ2P/wAALCAAIAAgBAREA/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQR"
+    "BRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4"
+    "eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/9oACAEB"
+    "AAA/APQK/9k="
+)
+SAMPLE_OCR_TEXT = (
+    "РАХУНОК-ФАКТУРА № 2024-117\n"
+    "Постачальник: ТОВ «Альфа Сервіс», код ЄДРПОУ 12345678\n"
+    "Покупець: ФОП Коваленко О. В.\n\n"
+    "1. Обслуговування серверів за листопад — 12 500,00 грн\n"
+    "2. Технічна підтримка — 3 200,00 грн\n\n"
+    "Разом до сплати: 15 700,00 грн. Оплатити до 10.12.2024."
+)
+SAMPLE_AI_TEXT = (
+    "👋 *Тип документу:* Рахунок-фактура\n\n"
+    "💡 *Головне:*\nТОВ «Альфа Сервіс» виставило рахунок на 15 700 грн за обслуговування серверів.\n\n"
+    "⚡ *Що треба зробити:* Оплатити до 10.12.2024."
+)
+
+
+class FakeBackend:
+    """Спільна логіка фейків: латентність з розкидом, частка помилок, лічильник викликів."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _delay(self):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return delay, failed
+
+    def call(self, name):
+        delay, failed = self._delay()
+        time.sleep(delay)
+        if failed:
+            raise RuntimeError(f"fake {name} error")
+
+
+class FakeVisionClient(FakeBackend):
+    """Повертає SAMPLE_OCR_TEXT з номером виклику, щоб кожне розпізнавання давало новий текст
+    (інакше кеш результатів ШІ обслуговував би всі запити після першого)."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._documents = itertools.count(1)
+
+    def document_text_detection(self, image=None):
+        self.call("vision")
+        text = f"{SAMPLE_OCR_TEXT}\nДокумент №{next(self._documents)}"
+        return SimpleNamespace(error=SimpleNamespace(message=""), full_text_annotation=SimpleNamespace(text=text))
+
+    def batch_annotate_files(self, requests=None):
+        self.call("vision")
+        page = SimpleNamespace(full_text_annotation=SimpleNamespace(text=SAMPLE_OCR_TEXT))
+        file_response = SimpleNamespace(error=SimpleNamespace(message=""), responses=[page, page])
+        return SimpleNamespace(responses=[file_response])
+
+
+class FakeGeminiModel(FakeBackend):
+    """Імітує реєстр моделей і GenerativeModel.generate_content, включно зі stream=True (chunks частин відповіді)."""
+
+    def __init__(self, chunks=4, **kwargs):
+        super().__init__(**kwargs)
+        self.chunks = chunks
+        self.profiles = Counter()
+
+    def get(self, profile):
+        """Інтерфейс реєстру main.GeminiModels: одна фейкова модель на всі профілі."""
+        self.profiles[profile] += 1
+        return self
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        usage = SimpleNamespace(prompt_token_count=len(prompt) // 3, candidates_token_count=len(SAMPLE_AI_TEXT) // 3)
+        if not stream:
+            self.call("gemini")
+            return SimpleNamespace(text=SAMPLE_AI_TEXT, usage_metadata=usage)
+        return self._stream(usage)
+
+    def _stream(self, usage):
+        delay, failed = self._delay()
+        step = max(1, len(SAMPLE_AI_TEXT) // self.chunks)
+        for start in range(0, len(SAMPLE_AI_TEXT), step):
+            time.sleep(delay / self.chunks)
+            if failed:
+                raise RuntimeError("fake gemini stream error")
+            yield SimpleNamespace(text=SAMPLE_AI_TEXT[start:start + step], usage_metadata=usage)
+
+
+class _FakeSnapshot:
+    def __init__(self, data, update_time=None):
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return copy.copy(self._data)
+
+
+class _FakeDocument:
+    def __init__(self, db, path):
+        self._db = db
+        self._path = path
+
+    def get(self):
+        self._db.call("firestore")
+        with self._db.lock:
+            return _FakeSnapshot(copy.deepcopy(self._db.store.get(self._path)), self._db.versions[self._path])
+
+    def set(self, data):
+        self._db.call("firestore")
+        with self._db.lock:
+            self._db.store[self._path] = dict(data)
+            self._db.versions[self._path] += 1
+
+    def create(self, data):
+        from google.api_core import exceptions
+        self._db.call("firestore")
+        with self._db.lock:
+            if self._path in self._db.store:
+                raise exceptions.AlreadyExists(self._path)
+            self._db.store[self._path] = copy.deepcopy(data)
+            self._db.versions[self._path] += 1
+
+    def delete(self):
+        self._db.call("firestore")
+        with self._db.lock:
+            self._db.store.pop(self._path, None)
+            self._db.versions[self._path] += 1
+
+    def update(self, fields, option=None):
+        """Як у Firestore: ключ "a.b" оновлює вкладене поле, не чіпаючи сусідні.
+
+        option=write_option(last_update_time=...) — запис лише якщо документ не змінювався.
+        """
+        from google.api_core import exceptions
+        self._db.call("firestore")
+        with self._db.lock:
+            if option is not None and option.last_update_time != self._db.versions[self._path]:
+                raise exceptions.FailedPrecondition(self._path)
+            self._db.versions[self._path] += 1
+            data = self._db.store[self._path]
+            for path, value in fields.items():
+                *parents, name = path.split(".")
+                target = data
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                target[name] = copy.deepcopy(value)
+
+
+class _FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, document, data):
+        self._writes.append((document._path, dict(data)))
+
+    def commit(self):
+        self._db.call("firestore")
+        with self._db.lock:
+            self._db.store.update(self._writes)
+            for path, _ in self._writes:
+                self._db.versions[path] += 1
+
+
+class FakeFirestore(FakeBackend):
+    """Firestore у пам'яті: collection().document().get()/set()/create()/update()/delete(), batch() і write_option()."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.store = {}
+        self.versions = Counter()  # update_time документа — лічильник записів
+        self.lock = threading.Lock()
+
+    def collection(self, name):
+        return SimpleNamespace(document=lambda doc_id: _FakeDocument(self, f"{name}/{doc_id}"))
+
+    def batch(self):
+        return _FakeBatch(self)
+
+    def write_option(self, last_update_time):
+        return SimpleNamespace(last_update_time=last_update_time)
+
+
+class OfflineTelegramRequest(BaseRequest):
+    """Транспорт Bot API, що відповідає локально. Записує всі виклики в `calls`."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self._message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if "/file/bot" in url:
+            self.calls.append(("downloadFile", {}))
+            return 200, FAKE_JPEG + url.encode("utf-8")
+
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((api_method, params))
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode("utf-8")
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return FAKE_BOT_USER
+        if api_method == "getFile":
+            return {"file_id": params.get("file_id"), "file_unique_id": f"u_{params.get('file_id')}",
+                    "file_size": len(FAKE_JPEG), "file_path": f"photos/{params.get('file_id')}.jpg"}
+        if api_method in ("sendMessage", "sendDocument", "editMessageText"):
+            chat_id = params.get("chat_id", 1)
+            return {"message_id": params.get("message_id") or next(self._message_ids), "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        return True
@@ -0,0 +1,131 @@
+"""Фаз-тест форматера: відповіді Gemini і сирий OCR -> валідний HTML Telegram.
+
+Корпус benchmarks/fixtures/ocr_corpus.json (реальні виводи OCR і Gemini) плюс
+випадкові мутації зі спецсимволами розмітки проганяються через format_plain і
+format_markdown. Кожне повідомлення перевіряється html.parser: лише теги
+Telegram (b, i, code, pre), правильна вкладеність, немає сирих < > &, довжина
+в межах ліміту. Додатково перевіряється, що текст не губиться.
+
+    python -m benchmarks.formatter_fuzz --mutations 2000 --seed 7
+"""
+import argparse
+import json
+import os
+import pathlib
+import random
+import re
+import sys
+from html.parser import HTMLParser
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:fuzz")
+os.environ.setdefault("GEMINI_API_KEY", "fuzz")
+os.environ.setdefault("METRICS_LOG", "0")
+
+import main
+
+CORPUS = pathlib.Path(__file__).parent / "fixtures" / "ocr_corpus.json"
+TELEGRAM_LIMIT = 4096
+ALLOWED_TAGS = {"b", "i", "code", "pre"}
+NOISE = ["*", "**", "_", "__", "`", "```", "<", ">", "&", "&amp;", "#", "- ", "\n", "\n\n", " ", "\\", "[", "]", "'", '"']
+RAW_ENTITY = re.compile(r"&(?!(?:amp|lt|gt|quot);)")
+MARKUP = re.compile(r"[\s*_`#•\\-]")
+
+
+class TelegramHTMLValidator(HTMLParser):
+    """Збирає помилки розмітки та видимий текст одного повідомлення."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.errors = []
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ALLOWED_TAGS:
+            self.errors.append(f"недозволений тег <{tag}>")
+        if self.stack and self.stack[-1] in ("code", "pre"):
+            self.errors.append(f"тег <{tag}> всередині <{self.stack[-1]}>")
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            self.errors.append(f"незбалансований </{tag}>")
+        else:
+            self.stack.pop()
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+
+def validate(message, limit):
+    """Список помилок повідомлення і його видимий текст."""
+    errors = []
+    stripped = re.sub(r"</?(?:b|i|code|pre)>", "", message)
+    if "<" in stripped or ">" in stripped:
+        errors.append("сирий < або >")
+    if RAW_ENTITY.search(message):
+        errors.append("сирий &")
+    parser = TelegramHTMLValidator()
+    parser.feed(message)
+    parser.close()
+    errors += parser.errors
+    if parser.stack:
+        errors.append(f"незакриті теги {parser.stack}")
+    visible = "".join(parser.text)
+    if len(visible) > min(limit + 200, TELEGRAM_LIMIT):  # + запас на заголовок
+        errors.append(f"задовге: {len(visible)}")
+    return errors, visible
+
+
+def mutate(text, rng):
+    chars = list(text)
+    for _ in range(rng.randint(1, 12)):
+        chars.insert(rng.randint(0, len(chars)), rng.choice(NOISE))
+    return "".join(chars)
+
+
+def check(kind, text, formatter, limit, failures):
+    parts = formatter(text, limit)
+    visible = []
+    for number, message in enumerate(parts):
+        errors, message_text = validate(message, limit)
+        visible.append(message_text)
+        for error in errors:
+            failures.append((kind, error, text[:80], number))
+    # Розбиття й екранування не мають губити чи дублювати текст (пробіли, маркери
+    # розмітки і рядки-огорожі ``` з назвою мови не рахуються)
+    source = "\n".join(line for line in text.split("\n") if not main._FENCE.match(line)) if kind == "ai" else text
+    if MARKUP.sub("", "".join(visible)) != MARKUP.sub("", source):
+        failures.append((kind, "текст змінено", text[:80], None))
+    return len(parts)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mutations", type=int, default=500, help="мутацій на кожен зразок корпусу")
+    parser.add_argument("--limit", type=int, default=main.MAX_MESSAGE_LENGTH)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    corpus = json.loads(CORPUS.read_text(encoding="utf-8"))
+    rng = random.Random(args.seed)
+    failures, checked, messages = [], 0, 0
+    for kind, formatter in (("ocr", main.format_plain), ("ai", main.format_markdown)):
+        # Обидва форматери проганяються по всьому корпусу: Gemini часто цитує OCR дослівно
+        for sample in corpus["ocr"] + corpus["ai"]:
+            for text in [sample] + [mutate(sample, rng) for _ in range(args.mutations // 10 or 1)]:
+                messages += check(kind, text, formatter, args.limit, failures)
+                checked += 1
+        for _ in range(args.mutations):
+            text = mutate(rng.choice(corpus[kind]), rng)
+            messages += check(kind, text, formatter, args.limit, failures)
+            checked += 1
+
+    print(f"texts={checked} messages={messages} failures={len(failures)}")
+    for kind, error, sample, number in failures[:20]:
+        print(f"  [{kind}] {error} (повідомлення {number}): {sample!r}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,132 @@
+"""Бенчмарк підготовки зображень: байти завантаження й Vision, латентність і точність OCR.
+
+Фікстури — каталог із зображеннями (*.jpg, *.jpeg, *.png) і необов'язковими
+еталонними текстами з тим самим ім'ям (*.txt). За замовчуванням береться
+benchmarks/fixtures/documents (генерується benchmarks.make_document_fixtures).
+
+Для кожного зображення імітуються варіанти PhotoSize, які Telegram створює для
+фото (довша сторона 90, 320, 800, 1280, 2560, але не більша за оригінал). Звіт
+показує байти завантаження з Telegram для найбільшого варіанта (стара поведінка)
+і для pick_photo_size, а також байти й час preprocess_image з різними
+--max-sides на обраному варіанті. Цей звіт працює офлайн.
+
+З --vision для кожного варіанта виконується справжній виклик Vision і
+рахується точність відносно еталона (або OCR найбільшого варіанта, якщо еталону
+немає), тож потрібні облікові дані Google Cloud.
+
+    python -m benchmarks.image_preprocessing
+    python -m benchmarks.image_preprocessing fixtures/documents --max-sides 2048 1600 1280 --vision
+"""
+import argparse
+import asyncio
+import difflib
+import io
+import pathlib
+import statistics
+import time
+from types import SimpleNamespace
+
+import main
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+DEFAULT_FIXTURES = pathlib.Path(__file__).parent / "fixtures" / "documents"
+TELEGRAM_PHOTO_SIDES = (90, 320, 800, 1280, 2560)
+TELEGRAM_JPEG_QUALITY = 87
+
+
+def similarity(expected, actual):
+    """Символьна схожість (0..1) після нормалізації пробілів."""
+    return difflib.SequenceMatcher(None, " ".join(expected.split()), " ".join((actual or "").split())).ratio()
+
+
+def telegram_photo_sizes(image_bytes):
+    """Імітує масив PhotoSize: [(SimpleNamespace(width, height, file_size), bytes)] від меншого до більшого."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img = img.convert("RGB")
+        longest = max(img.size)
+        sides = sorted({min(side, longest) for side in TELEGRAM_PHOTO_SIDES})
+        variants = []
+        for side in sides:
+            scale = side / longest
+            resized = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+            output = io.BytesIO()
+            resized.save(output, format="JPEG", quality=TELEGRAM_JPEG_QUALITY)
+            data = output.getvalue()
+            variants.append((SimpleNamespace(width=resized.width, height=resized.height, file_size=len(data)), data))
+    return variants
+
+
+def measure_preprocess(image_bytes, max_side):
+    start = time.perf_counter()
+    payload = image_bytes if max_side is None else main.preprocess_image(image_bytes, max_side=max_side)
+    return payload, (time.perf_counter() - start) * 1000
+
+
+async def measure_vision(payload):
+    start = time.perf_counter()
+    text = await main.real_vision_api(payload)
+    return text or "", (time.perf_counter() - start) * 1000
+
+
+async def run(fixtures, max_sides, vision):
+    images = sorted(p for p in pathlib.Path(fixtures).iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    if not images:
+        raise SystemExit(f"У {fixtures} немає зображень")
+
+    downloads = {"largest": [], "pick_photo_size": []}
+    variants = [("largest", None), ("pick_photo_size", None)] + [("pick_photo_size", side) for side in max_sides]
+    rows = {variant: [] for variant in variants}
+    for path in images:
+        sizes = telegram_photo_sizes(path.read_bytes())
+        by_size = {id(size): data for size, data in sizes}
+        chosen = {
+            "largest": sizes[-1][0],
+            "pick_photo_size": main.pick_photo_size([size for size, _ in sizes]),
+        }
+        for name, size in chosen.items():
+            downloads[name].append(size)
+
+        truth_path = path.with_suffix(".txt")
+        reference = truth_path.read_text(encoding="utf-8") if truth_path.exists() else None
+        for variant in variants:
+            source, max_side = variant
+            payload, prep_ms = measure_preprocess(by_size[id(chosen[source])], max_side)
+            row = {"bytes": len(payload), "prep_ms": prep_ms, "vision_ms": None, "accuracy": None}
+            if vision:
+                text, row["vision_ms"] = await measure_vision(payload)
+                if reference is None:
+                    reference = text
+                row["accuracy"] = similarity(reference, text)
+            rows[variant].append(row)
+
+    print(f"fixtures={len(images)} target_side={main.OCR_TARGET_SIDE}")
+    print(f"{'download':<18}{'side (median)':>14}{'bytes (median)':>16}{'bytes (total)':>15}")
+    for name, data in downloads.items():
+        print(f"{name:<18}{statistics.median(max(s.width, s.height) for s in data):>14.0f}"
+              f"{statistics.median(s.file_size for s in data):>16.0f}{sum(s.file_size for s in data):>15}")
+
+    print()
+    header = f"{'photo size':<18}{'preprocess':<16}{'bytes (median)':>16}{'prep ms':>10}"
+    print(header + (f"{'vision ms':>11}{'accuracy':>10}" if vision else ""))
+    for variant in variants:
+        data = rows[variant]
+        source, max_side = variant
+        label = "as is" if max_side is None else f"max_side={max_side}"
+        line = (f"{source:<18}{label:<16}{statistics.median(r['bytes'] for r in data):>16.0f}"
+                f"{statistics.median(r['prep_ms'] for r in data):>10.1f}")
+        if vision:
+            line += (f"{statistics.median(r['vision_ms'] for r in data):>11.1f}"
+                     f"{statistics.fmean(r['accuracy'] for r in data):>10.3f}")
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures", nargs="?", default=str(DEFAULT_FIXTURES),
+                        help="каталог із зображеннями та еталонними *.txt")
+    parser.add_argument("--max-sides", type=int, nargs="+", default=[main.OCR_MAX_SIDE, 1600, 1280])
+    parser.add_argument("--vision", action="store_true", help="виміряти точність справжнім викликом Vision")
+    args = parser.parse_args()
+    asyncio.run(run(args.fixtures, args.max_sides, args.vision))
@@ -0,0 +1,200 @@
+"""Офлайн навантажувальний тест main_logic з фейковими бекендами.
+
+Записані апдейти з benchmarks/fixtures/updates.json (фото, фото з підписом,
+альбом, натискання кнопки) програються через `telegram_webhook` (як потоки
+HTTP-сервера Cloud Functions) або через шлях polling (`handle_update` в одному
+event loop). Telegram, Vision, Gemini і Firestore замінено фейками з
+налаштовуваною латентністю та часткою помилок. Кожен прогін сценарію отримує
+власні update_id, чат і файли, тож дедуплікація і кеші не спотворюють замір.
+
+    python -m benchmarks.load_test --path webhook --requests 200 --concurrency 16
+    python -m benchmarks.load_test --path polling --scenarios photo callback \
+        --vision-latency 0.8 --gemini-latency 2 --error-rate 0.05 --stages
+"""
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:load-test")
+os.environ.setdefault("GEMINI_API_KEY", "load-test")
+os.environ.setdefault("METRICS_LOG", "0")
+
+import telegram
+
+import main
+from benchmarks.cold_start import FakeHttpRequest
+from benchmarks.fakes import (
+    SAMPLE_OCR_TEXT, FakeFirestore, FakeGeminiModel, FakeVisionClient, OfflineTelegramRequest,
+)
+from benchmarks.stats import summarize
+
+FIXTURES = pathlib.Path(__file__).parent / "fixtures" / "updates.json"
+
+
+class Replayer:
+    """Готує унікальні копії сценаріїв: свій update_id, чат, media_group_id і файли."""
+
+    def __init__(self, scenarios, chats, repeat_files):
+        self.scenarios = scenarios
+        self.chats = chats
+        self.repeat_files = repeat_files
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def next(self, index):
+        scenario = self.scenarios[index % len(self.scenarios)]
+        with self._lock:
+            run_id = next(self._ids)
+        chat_id = 10_000 + run_id % self.chats
+        updates = []
+        for number, payload in enumerate(copy.deepcopy(scenario["updates"])):
+            payload["update_id"] = run_id * 100 + number
+            message = payload.get("message") or payload["callback_query"]["message"]
+            message["chat"]["id"] = chat_id
+            if "message" in payload:
+                payload["message"]["from"]["id"] = chat_id
+                if "media_group_id" in message:
+                    message["media_group_id"] = f"group-{run_id}"
+                for size in message.get("photo", []):
+                    if not self.repeat_files:
+                        size["file_id"] += f"-{run_id}"
+                        size["file_unique_id"] += f"-{run_id}"
+            else:
+                payload["callback_query"]["id"] = f"cb-{run_id}"
+                payload["callback_query"]["from"]["id"] = chat_id
+                message["message_id"] = run_id
+            updates.append(payload)
+        return scenario["name"], chat_id, updates
+
+
+def install_fakes(args):
+    request = OfflineTelegramRequest(latency=args.telegram_latency)
+    backends = {
+        "vision": FakeVisionClient(latency=args.vision_latency, jitter=args.vision_latency / 4, error_rate=args.error_rate, seed=1),
+        "gemini": FakeGeminiModel(latency=args.gemini_latency, jitter=args.gemini_latency / 4, error_rate=args.error_rate, seed=2),
+        "firestore": FakeFirestore(latency=args.firestore_latency, seed=3),
+    }
+    main.clients.set("bot", telegram.Bot(token=os.environ["TELEGRAM_BOT_TOKEN"], request=request))
+    for name, backend in backends.items():
+        main.clients.set(name, backend)
+    return request, backends
+
+
+def seed_session(db, chat_id, updates):
+    """Кнопки меню посилаються на повідомлення, текст якого вже є в кеші сесії."""
+    for payload in updates:
+        if "callback_query" in payload:
+            message_id = payload["callback_query"]["message"]["message_id"]
+            # Власний текст на кожен прогін, щоб не міряти лише кеш результатів ШІ
+            db.store[f"ocr_cache/{chat_id}_{message_id}"] = main.pack_value(f"{SAMPLE_OCR_TEXT}\n#{chat_id}_{message_id}")
+
+
+def run_webhook(replayer, db, requests, concurrency):
+    def one(index):
+        name, chat_id, updates = replayer.next(index)
+        seed_session(db, chat_id, updates)
+        start = time.perf_counter()
+        # Сторінки альбому приходять окремими HTTP-запитами майже одночасно
+        with ThreadPoolExecutor(max_workers=len(updates)) as pages:
+            statuses = list(pages.map(lambda payload: main.telegram_webhook(FakeHttpRequest(payload))[1], updates))
+        return name, time.perf_counter() - start, all(status == 200 for status in statuses)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(requests)))
+
+
+async def run_polling(replayer, db, requests, concurrency):
+    await main.ensure_bot_initialized()
+    bot = main.get_bot()
+    slots = asyncio.Semaphore(concurrency)  # як concurrent_updates у Application
+
+    async def one(index):
+        async with slots:
+            name, chat_id, updates = replayer.next(index)
+            seed_session(db, chat_id, updates)
+            start = time.perf_counter()
+            try:
+                await asyncio.gather(*(main.handle_update(telegram.Update.de_json(p, bot)) for p in updates))
+                ok = True
+            except Exception:
+                ok = False
+            return name, time.perf_counter() - start, ok
+
+    results = await asyncio.gather(*(one(index) for index in range(requests)))
+    await main.cache_writes.flush()
+    return results
+
+
+def report(results, elapsed, request, backends, sink, show_stages):
+    print(f"scenarios={len(results)} elapsed={elapsed:.2f}s throughput={len(results) / elapsed:.1f}/s "
+          f"failed={sum(1 for _, _, ok in results if not ok)}")
+    by_name = {}
+    for name, latency, _ in results:
+        by_name.setdefault(name, []).append(latency)
+    for name, timings in [("all", [latency for _, latency, _ in results])] + sorted(by_name.items()):
+        stats = summarize(timings)
+        print(f"  {name:<14} n={stats['count']:<5} p50={stats['p50_ms']:8.1f}ms p95={stats['p95_ms']:8.1f}ms p99={stats['p99_ms']:8.1f}ms")
+
+    print("backend calls:")
+    for name, backend in backends.items():
+        print(f"  {name:<10} calls={backend.calls:<6} errors={backend.errors}")
+    telegram_calls = Counter(method for method, _ in request.calls)
+    print("  telegram   " + ", ".join(f"{method}={count}" for method, count in sorted(telegram_calls.items())))
+
+    if show_stages:
+        print("stages:")
+        for stage, labels, count, p50, p95 in sink.summary():
+            label_text = ",".join(f"{k}={v}" for k, v in labels.items())
+            print(f"  {stage:<20} {label_text:<44} n={count:<5} p50={p50:8.1f}ms p95={p95:8.1f}ms")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--requests", type=int, default=100, help="кількість прогонів сценаріїв")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--scenarios", nargs="+", help="назви сценаріїв з фікстур (за замовчуванням усі)")
+    parser.add_argument("--chats", type=int, default=1000, help="скільки різних чатів імітувати")
+    parser.add_argument("--repeat-files", action="store_true", help="однакові file_unique_id — перевірка кешу OCR")
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--vision-latency", type=float, default=0.4)
+    parser.add_argument("--gemini-latency", type=float, default=1.5)
+    parser.add_argument("--firestore-latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="частка помилок Vision і Gemini")
+    parser.add_argument("--media-group-window", type=float, default=0.3)
+    parser.add_argument("--stages", action="store_true", help="показати p50/p95 по етапах з метрик")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger("main").setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+    main.MEDIA_GROUP_WINDOW = args.media_group_window
+    sink = main.InMemoryMetricsSink()
+    main.set_metrics_sink(sink)
+
+    scenarios = json.loads(FIXTURES.read_text(encoding="utf-8"))
+    if args.scenarios:
+        scenarios = [s for s in scenarios if s["name"] in args.scenarios]
+    replayer = Replayer(scenarios, args.chats, args.repeat_files)
+    request, backends = install_fakes(args)
+
+    start = time.perf_counter()
+    if args.path == "webhook":
+        results = run_webhook(replayer, backends["firestore"], args.requests, args.concurrency)
+    else:
+        results = asyncio.run(run_polling(replayer, backends["firestore"], args.requests, args.concurrency))
+    report(results, time.perf_counter() - start, request, backends, sink, args.stages)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,105 @@
+"""Генерує фікстури для benchmarks.image_preprocessing: «фото» документів і еталонні тексти.
+
+Текст рендериться шрифтом DejaVu на злегка жовтуватому тлі з шумом і невеликим
+нахилом, як фото з телефона, і зберігається в JPEG; поруч — еталон *.txt.
+Результат детермінований (фіксований seed), тому фікстури можна перегенерувати.
+
+    python -m benchmarks.make_document_fixtures
+"""
+import pathlib
+import random
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+OUTPUT = pathlib.Path(__file__).parent / "fixtures" / "documents"
+FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+DOCUMENTS = {
+    "invoice": (1500, 2000, 30, [
+        "РАХУНОК-ФАКТУРА № СФ-0000127",
+        "від 14 березня 2024 р.",
+        "",
+        "Постачальник: ТОВ \"Альфа Трейд\"",
+        "ЄДРПОУ 41234567",
+        "IBAN UA21 3052 9900 0002 6007 0160 1234 5",
+        "Покупець: ФОП Петренко Олена Іванівна",
+        "",
+        "1. Папір офісний А4, 80 г/м2 — 10 уп. x 189,00 = 1 890,00",
+        "2. Картридж HP 85A — 2 шт. x 1 250,00 = 2 500,00",
+        "3. Доставка по Києву — 1 x 150,00 = 150,00",
+        "",
+        "Всього без ПДВ: 4 540,00 грн",
+        "ПДВ 20%: 908,00 грн",
+        "Разом до сплати: 5 448,00 грн",
+        "",
+        "Оплатити до 25 березня 2024 р.",
+        "Директор ____________ Іваненко І.І.",
+    ]),
+    "contract": (1600, 2200, 26, [
+        "ДОГОВІР ОРЕНДИ № 12/03-24",
+        "м. Київ, 1 квітня 2024 р.",
+        "",
+        "1. ПРЕДМЕТ ДОГОВОРУ",
+        "1.1. Орендодавець передає, а Орендар приймає у тимчасове",
+        "платне користування нежитлове приміщення площею 48,5 м2",
+        "за адресою: м. Київ, вул. Хрещатик, 22, офіс 5.",
+        "1.2. Строк оренди становить 11 місяців.",
+        "",
+        "2. ОРЕНДНА ПЛАТА",
+        "2.1. Орендна плата становить 15 000 грн на місяць.",
+        "2.2. Плата вноситься щомісяця до 5-го числа.",
+        "2.3. Комунальні послуги оплачуються окремо.",
+        "",
+        "3. ВІДПОВІДАЛЬНІСТЬ СТОРІН",
+        "3.1. За прострочення оплати Орендар сплачує пеню",
+        "у розмірі 0,1% від суми боргу за кожен день.",
+        "",
+        "Орендодавець ____________ Орендар ____________",
+    ]),
+    "receipt": (900, 1800, 28, [
+        "ТОВ «Сільпо-Фуд»",
+        "Чек № 0012",
+        "12.02.2024 18:42",
+        "",
+        "Молоко 2,5% 1л x2      79,80",
+        "Хліб Український       32,50",
+        "Сир твердий 200г      124,90",
+        "Яблука 1,2 кг          46,68",
+        "Знижка -5%            -14,19",
+        "",
+        "СУМА                  269,69",
+        "Картка ****1234",
+        "ФН 4000123456",
+        "Дякуємо за покупку!",
+    ]),
+}
+
+
+def render(width, height, font_size, lines, rng):
+    image = Image.new("RGB", (width, height), (246, 241, 226))
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.truetype(FONT, font_size)
+    y = font_size * 3
+    for line in lines:
+        draw.text((font_size * 2, y), line, fill=(35, 35, 40), font=font)
+        y += int(font_size * 1.7)
+    pixels = image.load()
+    for _ in range(width * height // 40):  # зерно камери
+        x, y = rng.randrange(width), rng.randrange(height)
+        shade = rng.randint(200, 255)
+        pixels[x, y] = (shade, shade - 5, shade - 20)
+    image = image.rotate(rng.uniform(-1.5, 1.5), resample=Image.BICUBIC, fillcolor=(120, 110, 100))
+    return image.filter(ImageFilter.GaussianBlur(0.6))
+
+
+def main_cli():
+    OUTPUT.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(7)
+    for name, (width, height, font_size, lines) in DOCUMENTS.items():
+        render(width, height, font_size, lines, rng).save(OUTPUT / f"{name}.jpg", quality=82)
+        (OUTPUT / f"{name}.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+        print(f"{name}.jpg {(OUTPUT / f'{name}.jpg').stat().st_size} bytes")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,96 @@
+"""Перевірка й замір map-reduce рушія real_gemini_api на локальній фейковій моделі.
+
+Фейкова модель відповідає із затримкою, пропорційною розміру промпта, і
+повертає маркери абзаців, які бачила. Скрипт перевіряє, що фрагменти не
+перевищують бюджет, паралелізм не перевищує ліміт, а reduce-промпт містить
+факти всіх сторінок у правильному порядку. Також порівнюється час з одним
+викликом на весь текст.
+
+    python -m benchmarks.map_reduce --pages 30 --chunk-tokens 2000 --concurrency 4
+"""
+import argparse
+import asyncio
+import re
+import time
+
+import main
+
+MARKER = re.compile(r"Маркер \d+")
+
+
+class FakeGenerator:
+    """Локальна модель: латентність = base + per_1k_tokens * (токени промпта / 1000)."""
+
+    def __init__(self, base_latency, per_1k_tokens):
+        self.base_latency = base_latency
+        self.per_1k_tokens = per_1k_tokens
+        self.prompts = []
+        self.inflight = 0
+        self.max_inflight = 0
+
+    async def generate(self, prompt, on_chunk=None):
+        self.prompts.append(prompt)
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(self.base_latency + self.per_1k_tokens * main.estimate_tokens(prompt) / 1000)
+            result = " ".join(MARKER.findall(prompt))
+            if on_chunk is not None:
+                await on_chunk(result)
+            return result
+        finally:
+            self.inflight -= 1
+
+
+def make_document(pages, paragraphs_per_page):
+    filler = "Сторона зобов'язується виконати умови договору у встановлений строк. " * 6
+    number = 0
+    result = []
+    for page in range(1, pages + 1):
+        paragraphs = []
+        for _ in range(paragraphs_per_page):
+            number += 1
+            paragraphs.append(f"Маркер {number}. {filler}")
+        result.append(f"--- Сторінка {page} ---\n" + "\n\n".join(paragraphs))
+    return "\n\n".join(result), number
+
+
+async def run(pages, paragraphs, chunk_tokens, concurrency, base_latency, per_1k_tokens):
+    text, markers = make_document(pages, paragraphs)
+    expected = [f"Маркер {n}" for n in range(1, markers + 1)]
+
+    chunks = main.split_into_chunks(text, chunk_tokens)
+    assert all(main.estimate_tokens(chunk) <= chunk_tokens + 1 for chunk in chunks), "фрагмент перевищує бюджет"
+    assert MARKER.findall("\n".join(chunks)) == expected, "фрагменти втратили або переставили абзаци"
+
+    single = FakeGenerator(base_latency, per_1k_tokens)
+    start = time.perf_counter()
+    await single.generate(main.build_prompt("summarize", text))
+    single_time = time.perf_counter() - start
+
+    mapped = FakeGenerator(base_latency, per_1k_tokens)
+    start = time.perf_counter()
+    await main.map_reduce_generate(text, "summarize", mapped.generate, max_tokens=chunk_tokens, concurrency=concurrency)
+    map_reduce_time = time.perf_counter() - start
+
+    reduce_prompt = mapped.prompts[-1]
+    assert MARKER.findall(reduce_prompt) == expected, "reduce-промпт порушує порядок фактів"
+    assert mapped.max_inflight <= concurrency, "перевищено ліміт паралельних map-викликів"
+
+    print(f"text={len(text)} chars (~{main.estimate_tokens(text)} tokens), chunks={len(chunks)}, "
+          f"calls={len(mapped.prompts)}, max_inflight={mapped.max_inflight}")
+    print(f"single call   {single_time * 1000:8.1f}ms  prompt={main.estimate_tokens(single.prompts[0])} tokens")
+    print(f"map-reduce    {map_reduce_time * 1000:8.1f}ms  reduce prompt={main.estimate_tokens(reduce_prompt)} tokens")
+    print("OK: бюджет фрагментів, ліміт паралелізму і порядок фактів дотримано")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=30)
+    parser.add_argument("--paragraphs", type=int, default=6)
+    parser.add_argument("--chunk-tokens", type=int, default=main.CHUNK_TOKENS)
+    parser.add_argument("--concurrency", type=int, default=main.MAP_CONCURRENCY)
+    parser.add_argument("--base-latency", type=float, default=0.3, help="секунди на виклик")
+    parser.add_argument("--per-1k-tokens", type=float, default=0.05, help="секунди на 1000 токенів промпта")
+    args = parser.parse_args()
+    asyncio.run(run(args.pages, args.paragraphs, args.chunk_tokens, args.concurrency, args.base_latency, args.per_1k_tokens))
@@ -0,0 +1,110 @@
+"""Розмір запиту до Gemini і латентність: один промпт з інструкцією проти реєстру моделей.
+
+Офлайн (за замовчуванням) будуються справжні GenerateContentRequest без мережі й
+порівнюється їх розмір для кожної команди:
+  legacy      — інструкція склеєна з текстом документа, одна модель на всі команди;
+  registry    — модель профілю з system_instruction і generation_config;
+  cached      — запит, що посилається на контекстний кеш (лише текст документа).
+
+З --live N кожен варіант викликається N разів через справжній API (потрібен
+GEMINI_API_KEY): p50 латентності, токени промпта і токени з кешу за usage_metadata.
+
+    python -m benchmarks.model_registry --text-file scan.txt
+    GEMINI_API_KEY=... python -m benchmarks.model_registry --live 5 --commands summarize translate_en
+"""
+import argparse
+import os
+import pathlib
+import textwrap
+import time
+import warnings
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("METRICS_LOG", "0")
+warnings.simplefilter("ignore", FutureWarning)  # google.generativeai попереджає про застарілість
+
+import google.generativeai as genai
+from google.generativeai import protos
+
+import main
+from benchmarks.fakes import SAMPLE_OCR_TEXT
+from benchmarks.stats import percentile
+
+LEGACY_MODEL = "gemini-2.5-flash"
+
+
+def legacy_prompt(command, text):
+    """Промпт у попередньому форматі: повна інструкція + документ в одному тексті."""
+    instruction = main.SYSTEM_PROMPTS.get(command) or main.CUSTOM_PROMPT.replace(
+        "запитом користувача.", f"запитом користувача: '{command}'."
+    )
+    return f"{instruction}\n\n=== ТЕКСТ ДОКУМЕНТА ===\n{text}\n======================="
+
+
+def registry_model(command):
+    profile = main.command_label(command)
+    name, generation_config = main.model_settings(profile)
+    return genai.GenerativeModel(name, system_instruction=main.system_instruction(profile), generation_config=generation_config)
+
+
+def request_size(model, contents):
+    request = model._prepare_request(contents=contents, tools=None, tool_config=None)
+    return len(protos.GenerateContentRequest.serialize(request)), request
+
+
+def offline(commands, text):
+    print(f"document: {len(text)} chars (~{main.estimate_tokens(text)} tokens)")
+    print(f"{'command':<20} {'model':<24} {'legacy':>9} {'registry':>9} {'cached':>9} {'instruction':>12}")
+    for command in commands:
+        legacy_size, _ = request_size(genai.GenerativeModel(LEGACY_MODEL), legacy_prompt(command, text))
+        registry_size, request = request_size(registry_model(command), main.build_prompt(command, text))
+        cached = protos.GenerateContentRequest(
+            model=request.model, contents=request.contents, generation_config=request.generation_config,
+            cached_content="cachedContents/0123456789abcdef",
+        )
+        cached_size = len(protos.GenerateContentRequest.serialize(cached))
+        instruction_tokens = main.estimate_tokens(main.system_instruction(main.command_label(command)))
+        print(f"{command[:20]:<20} {request.model.removeprefix('models/'):<24} {legacy_size:>8}B {registry_size:>8}B "
+              f"{cached_size:>8}B {instruction_tokens:>8} tok")
+    print(f"контекстний кеш створюється для інструкцій від {main.CONTEXT_CACHE_MIN_TOKENS} токенів "
+          f"(GEMINI_CONTEXT_CACHE={'1' if main.CONTEXT_CACHE_ENABLED else '0'})")
+
+
+def timed_call(model, contents):
+    start = time.perf_counter()
+    response = model.generate_content(contents)
+    usage = response.usage_metadata
+    return time.perf_counter() - start, usage.prompt_token_count, getattr(usage, "cached_content_token_count", 0) or 0
+
+
+def live(commands, text, runs):
+    legacy_model = genai.GenerativeModel(LEGACY_MODEL)
+    print(f"{'command':<14} {'variant':<9} {'p50':>9} {'max':>9} {'prompt tok':>11} {'cached tok':>11}")
+    for command in commands:
+        variants = (
+            ("legacy", legacy_model, legacy_prompt(command, text)),
+            ("registry", main.get_gemini_model(main.command_label(command)), main.build_prompt(command, text)),
+        )
+        for variant, model, contents in variants:
+            results = [timed_call(model, contents) for _ in range(runs)]
+            latencies = [latency for latency, _, _ in results]
+            print(f"{command:<14} {variant:<9} {percentile(latencies, 50) * 1000:>7.0f}ms {max(latencies) * 1000:>7.0f}ms "
+                  f"{results[-1][1]:>11} {results[-1][2]:>11}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--commands", nargs="+", default=list(main.SYSTEM_PROMPTS) + ["Які тут суми і дати?"])
+    parser.add_argument("--text-file", type=pathlib.Path, help="текст документа (за замовчуванням зразок OCR)")
+    parser.add_argument("--live", type=int, default=0, metavar="N", help="N викликів кожного варіанта через API")
+    args = parser.parse_args()
+
+    text = args.text_file.read_text(encoding="utf-8") if args.text_file else textwrap.dedent(SAMPLE_OCR_TEXT)
+    offline(args.commands, text)
+    if args.live:
+        genai.configure(api_key=main.get_secrets("GEMINI_API_KEY")[0])
+        live(args.commands, text, args.live)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,31 @@
+"""Спільні утиліти для звітів бенчмарків."""
+import math
+import statistics
+
+
+def percentile(values, q):
+    """Перцентиль q (0-100) методом найближчого рангу."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(timings):
+    """Зведення латентностей (секунди) у мілісекундах."""
+    return {
+        "count": len(timings),
+        "mean_ms": statistics.fmean(timings) * 1000 if timings else 0.0,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+    }
+
+
+def print_report(title, timings):
+    stats = summarize(timings)
+    print(
+        f"{title:<32} n={stats['count']:<5} mean={stats['mean_ms']:8.2f}ms "
+        f"p50={stats['p50_ms']:8.2f}ms p95={stats['p95_ms']:8.2f}ms p99={stats['p99_ms']:8.2f}ms"
+    )
@@ -0,0 +1,75 @@
+"""Мікробенчмарк накладних витрат webhook на один апдейт.
+
+Порівнює попередню схему (`asyncio.run` + новий HTTP-клієнт на кожен запит)
+із постійним runtime-loop з main.py та спільним пулом з'єднань httpx.
+Без --url вимірюється лише вартість event loop; з --url кожен "апдейт" робить
+HTTPS-запит, тож видно і вартість нових TLS-рукостискань.
+
+    TELEGRAM_BOT_TOKEN=dummy GEMINI_API_KEY=dummy python -m benchmarks.webhook_runtime
+    TELEGRAM_BOT_TOKEN=dummy GEMINI_API_KEY=dummy python -m benchmarks.webhook_runtime \
+        --url https://api.telegram.org --updates 30 --concurrency 4
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+import main
+from benchmarks.stats import print_report
+
+
+async def _handle(client, url):
+    if url:
+        await client.get(url)
+    else:
+        await asyncio.sleep(0)
+
+
+def fresh_loop_update(url):
+    """Поведінка до змін: новий loop і новий клієнт на кожен апдейт."""
+    async def handle():
+        async with httpx.AsyncClient() as client:
+            await _handle(client, url)
+
+    start = time.perf_counter()
+    asyncio.run(handle())
+    return time.perf_counter() - start
+
+
+def runtime_loop_update(client, url):
+    """Поточна поведінка: спільний runtime-loop і теплий пул з'єднань."""
+    start = time.perf_counter()
+    main.run_in_runtime(_handle(client, url))
+    return time.perf_counter() - start
+
+
+async def _make_client():
+    return httpx.AsyncClient(limits=httpx.Limits(max_connections=main.TELEGRAM_POOL_SIZE))
+
+
+def run(updates, concurrency, url):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        fresh = list(pool.map(lambda _: fresh_loop_update(url), range(updates)))
+
+    client = main.run_in_runtime(_make_client())
+    try:
+        main.run_in_runtime(_handle(client, url))  # прогрів, як у теплого інстансу
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            persistent = list(pool.map(lambda _: runtime_loop_update(client, url), range(updates)))
+    finally:
+        main.run_in_runtime(client.aclose())
+
+    print(f"updates={updates} concurrency={concurrency} url={url or '-'}")
+    print_report("asyncio.run per update", fresh)
+    print_report("persistent runtime loop", persistent)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--url", default="", help="HTTPS-адреса для імітації запиту до Telegram")
+    args = parser.parse_args()
+    run(args.updates, args.concurrency, args.url)
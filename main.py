@@ -1,29 +1,176 @@
 import os
 import io
+import re
+import zlib
+import time
 import asyncio
+import json
+import hashlib
+import itertools
+import math
+import html
+import textwrap
 import logging
+import functools
+import contextlib
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
 import functions_framework
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 
-# --- GOOGLE CLOUD IMPORTS ---
-from google.cloud import vision
-from google.cloud import firestore
-from google.cloud import secretmanager
-import google.generativeai as genai
+# Google Cloud SDK (vision, firestore, secretmanager) і google.generativeai
+# імпортуються ліниво у фабриках клієнтів (розділ 4) — це скорочує холодний старт.
 
 # --- 1. КОНФІГУРАЦІЯ ТА КОНСТАНТИ ---
 PROJECT_ID = os.environ.get("GCP_PROJECT", "documind-478420")
 REGION_ID = "europe-central2" 
-MODEL_NAME = "gemini-2.5-flash"
+
+# Рівні моделей Gemini і профіль кожної команди: рівень та параметри генерації.
+# Рівень команди можна перевизначити змінною MODEL_TIER_<КОМАНДА>, напр. MODEL_TIER_SUMMARIZE=pro
+MODEL_TIERS = {
+    "lite": os.environ.get("GEMINI_LITE_MODEL", "gemini-2.5-flash-lite"),
+    "standard": os.environ.get("GEMINI_MODEL", "gemini-2.5-flash"),
+    "pro": os.environ.get("GEMINI_PRO_MODEL", "gemini-2.5-pro"),
+}
+MODEL_PROFILES = {
+    "summarize": ("standard", {"temperature": 0.3}),
+    "keywords": ("standard", {"temperature": 0.2}),
+    "translate_en": ("lite", {"temperature": 0.1}),
+    "translate_ua": ("lite", {"temperature": 0.1}),
+    "custom": ("standard", {"temperature": 0.4}),
+    "map": ("lite", {"temperature": 0.0}),  # витяг фактів з фрагментів довгих документів
+}
+
+# Контекстний кеш Gemini для статичних інструкцій: API приймає лише достатньо довгі,
+# тому коротші інструкції передаються як system_instruction
+CONTEXT_CACHE_ENABLED = os.environ.get("GEMINI_CONTEXT_CACHE", "1") == "1"
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("CONTEXT_CACHE_MIN_TOKENS", "1024"))
+CONTEXT_CACHE_TTL_MINUTES = int(os.environ.get("CONTEXT_CACHE_TTL_MINUTES", "60"))
 
 MAX_MESSAGE_LENGTH = 3000
+# Довший текст надсилається кількома повідомленнями (не більше MAX_MESSAGE_PARTS), ще довший — файлом
+MAX_MESSAGE_PARTS = int(os.environ.get("MAX_MESSAGE_PARTS", "3"))
+
+# Кеш результатів OCR (ключ — file_unique_id Telegram або SHA-256 байтів зображення)
+OCR_CACHE_COLLECTION = "ocr_results"
+OCR_CACHE_TTL_DAYS = int(os.environ.get("OCR_CACHE_TTL_DAYS", "30"))
+OCR_CACHE_LRU_SIZE = int(os.environ.get("OCR_CACHE_LRU_SIZE", "256"))
+
+# Кеш відповідей Gemini (ключ — хеш тексту, команди, моделі та версії промптів)
+AI_CACHE_COLLECTION = "ai_results"
+AI_CACHE_TTL_DAYS = int(os.environ.get("AI_CACHE_TTL_DAYS", "7"))
+AI_CACHE_LRU_SIZE = int(os.environ.get("AI_CACHE_LRU_SIZE", "512"))
+
+# Кеш сесій: текст, до якого прив'язане меню повідомлення (ключ — chat_id_message_id).
+# Перед Firestore стоїть LRU у пам'яті, обмежений сумарним розміром текстів (символи)
+SESSION_CACHE_COLLECTION = "ocr_cache"
+SESSION_CACHE_TTL_HOURS = int(os.environ.get("SESSION_CACHE_TTL_HOURS", "48"))
+SESSION_CACHE_MAX_CHARS = int(os.environ.get("SESSION_CACHE_MAX_CHARS", str(16 * 1024 * 1024)))
+
+# Тексти, довші за цей поріг (байти UTF-8), зберігаються у Firestore стиснутими zlib
+CACHE_COMPRESS_MIN_BYTES = int(os.environ.get("CACHE_COMPRESS_MIN_BYTES", "2048"))
+# Записи кешів у Firestore відкладаються на CACHE_WRITE_DELAY секунд і комітяться одним batch
+CACHE_WRITE_DELAY = float(os.environ.get("CACHE_WRITE_DELAY", "0.2"))
+CACHE_WRITE_BATCH = int(os.environ.get("CACHE_WRITE_BATCH", "50"))
+FIRESTORE_BATCH_LIMIT = 500
+
+AI_ERROR_MESSAGE = "⚠️ Помилка AI."
+
+# Підготовка зображень для OCR: розмір PhotoSize, який вибирається з варіантів Telegram,
+# межа для зменшення великих зображень і якість перестиснення в JPEG
+OCR_TARGET_SIDE = int(os.environ.get("OCR_TARGET_SIDE", "1280"))
+OCR_MAX_SIDE = int(os.environ.get("OCR_MAX_SIDE", "2048"))
+OCR_JPEG_QUALITY = int(os.environ.get("OCR_JPEG_QUALITY", "85"))
+GRAYSCALE_SATURATION = 24  # середня насиченість (0-255), нижче якої зображення вважається ч/б
+
+# Файли-документи (без стиснення Telegram), які приймаються на OCR
+SUPPORTED_DOCUMENT_TYPES = ("image/jpeg", "image/png", "application/pdf")
+MAX_DOCUMENT_BYTES = 20 * 1024 * 1024  # ліміт завантаження Bot API
+
+# Альбоми (media group): скільки секунд чекати на наступну сторінку того ж альбому
+MEDIA_GROUP_WINDOW = float(os.environ.get("MEDIA_GROUP_WINDOW", "1.5"))
+# Сторінки альбому можуть потрапити на різні інстанси, тому стан групи — у Firestore
+MEDIA_GROUP_COLLECTION = "media_groups"
+MEDIA_GROUP_TTL_HOURS = 1
+
+# Спекулятивний prefetch (вимкнено, доки PREFETCH_COMMANDS порожній): команди, які
+# запускаються у фоні одразу після OCR, поки користувач читає меню
+PREFETCH_COMMANDS = [c.strip() for c in os.environ.get("PREFETCH_COMMANDS", "").split(",") if c.strip()]
+PREFETCH_MAX_CHARS = int(os.environ.get("PREFETCH_MAX_CHARS", "20000"))
+PREFETCH_MAX_INFLIGHT = int(os.environ.get("PREFETCH_MAX_INFLIGHT", "4"))
+PREFETCH_TIMEOUT = float(os.environ.get("PREFETCH_TIMEOUT", "60"))
+
+# Map-reduce для довгих документів: бюджет фрагмента в токенах (оцінка за кількістю
+# символів) і скільки фрагментів обробляти паралельно
+MAP_REDUCE_COMMANDS = ("summarize", "keywords")
+CHUNK_TOKENS = int(os.environ.get("CHUNK_TOKENS", "6000"))
+CHARS_PER_TOKEN = 3  # консервативно для кирилиці
+MAP_CONCURRENCY = int(os.environ.get("MAP_CONCURRENCY", "4"))
+
+# Пошук уривків для довільних запитів (підпис до фото): документ довший за
+# RETRIEVAL_MIN_TOKENS ділиться на уривки по PASSAGE_TOKENS, і в промпт ідуть лише
+# RETRIEVAL_TOP_K найрелевантніших за BM25. Якщо вони займають більше
+# RETRIEVAL_MAX_SHARE документа — надсилається повний текст
+RETRIEVAL_MIN_TOKENS = int(os.environ.get("RETRIEVAL_MIN_TOKENS", "1500"))
+PASSAGE_TOKENS = int(os.environ.get("PASSAGE_TOKENS", "250"))
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "4"))
+RETRIEVAL_MAX_SHARE = float(os.environ.get("RETRIEVAL_MAX_SHARE", "0.5"))
+PASSAGE_INDEX_CACHE_SIZE = int(os.environ.get("PASSAGE_INDEX_CACHE_SIZE", "64"))
+
+# Ліміти одночасних блокуючих викликів SDK (окремий пул потоків на кожен бекенд)
+BACKEND_CONCURRENCY = {
+    "vision": int(os.environ.get("VISION_CONCURRENCY", "4")),
+    "gemini": int(os.environ.get("GEMINI_CONCURRENCY", "8")),
+    "firestore": int(os.environ.get("FIRESTORE_CONCURRENCY", "16")),
+    "imaging": int(os.environ.get("IMAGING_CONCURRENCY", "2")),
+}
+# Стрімінг відповіді Gemini: мінімальний інтервал між редагуваннями повідомлення (секунди)
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_CURSOR = " ▌"
+
+# Admission control: дедуплікація повторних доставок update_id, ліміт запитів на чат
+# (token bucket) і глобальний ліміт одночасних апдейтів із чергою
+DEDUP_TTL = int(os.environ.get("DEDUP_TTL", "3600"))
+DEDUP_MAX_UPDATES = int(os.environ.get("DEDUP_MAX_UPDATES", "10000"))
+# Повторна доставка може потрапити на інший інстанс, тому update_id у роботі позначаються у Firestore
+DEDUP_COLLECTION = "processed_updates"
+CHAT_RATE = float(os.environ.get("CHAT_RATE", "0.2"))  # токенів за секунду
+CHAT_BURST = int(os.environ.get("CHAT_BURST", "5"))
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "16"))
+MAX_QUEUED_UPDATES = int(os.environ.get("MAX_QUEUED_UPDATES", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "30"))
+
+# Webhook: пул HTTP-з'єднань до Telegram і таймаут обробки одного апдейта (секунди)
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", "32"))
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", "300"))
+
+# Як довго тримати секрети в кеші процесу (секунди)
+SECRET_REFRESH_SECONDS = int(os.environ.get("SECRET_REFRESH_SECONDS", "3600"))
+
+# Скільки апдейтів обробляти паралельно в режимі polling
+POLLING_CONCURRENT_UPDATES = int(os.environ.get("POLLING_CONCURRENT_UPDATES", "16"))
 
 # Налаштування логування
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _apply_model_tier_overrides():
+    """MODEL_TIER_<КОМАНДА> перевіряється один раз: невідомий рівень лише логується, профіль лишає свій."""
+    for profile, (tier, generation_config) in MODEL_PROFILES.items():
+        override = os.environ.get(f"MODEL_TIER_{profile.upper()}")
+        if override is None or override == tier:
+            continue
+        if override in MODEL_TIERS:
+            MODEL_PROFILES[profile] = (override, generation_config)
+        else:
+            logger.warning(f"Невідомий рівень моделі MODEL_TIER_{profile.upper()}={override!r}, лишаю {tier!r}")
+
+_apply_model_tier_overrides()
+
 # --- 2. ПРОМПТИ (СИСТЕМНІ ІНСТРУКЦІЇ) ---
 SYSTEM_PROMPTS = {
     "summarize": """
@@ -119,13 +266,44 @@ SYSTEM_PROMPTS = {
     """
 }
 
+CUSTOM_PROMPT = "Ти корисний асистент. Проаналізуй документ згідно з запитом користувача. \nВАЖЛИВО: Використовуй тільки одинарні зірочки (*) для жирного шрифту."
+
+# Map-етап для довгих документів: стислий витяг фактів з одного фрагмента
+MAP_PROMPT = """
+    Ти — аналітик документів. Користувач надсилає один фрагмент великого документа.
+    Випиши всі суттєві факти цього фрагмента: тип документа (якщо видно), сторони, суми, дати,
+    терміни, зобов'язання, імена, назви та числа. Без вступів і висновків, лише факти списком.
+    Не вигадуй того, чого немає у фрагменті.
+    """
+
+REDUCE_NOTE = "Документ великий, тому нижче не повний текст, а впорядковані витяги фактів з його фрагментів. Сформуй відповідь для всього документа."
+
+# Відповідь на довільний запит за уривками; NO_ANSWER — сигнал повторити з повним текстом
+NO_ANSWER = "NO_ANSWER"
+RETRIEVAL_NOTE = (
+    "Нижче не весь документ, а найрелевантніші до запиту уривки у порядку появи в документі. "
+    f"Якщо для відповіді їх недостатньо, відповідай лише словом {NO_ANSWER}."
+)
+
+# Будь-яка зміна промптів інвалідує кеш відповідей Gemini
+PROMPTS_VERSION = hashlib.sha256(
+    json.dumps([SYSTEM_PROMPTS, CUSTOM_PROMPT, MAP_PROMPT, REDUCE_NOTE, RETRIEVAL_NOTE], sort_keys=True, ensure_ascii=False).encode("utf-8")
+).hexdigest()[:12]
+
 # --- 3. ОТРИМАННЯ СЕКРЕТІВ ---
+# Секрети кешуються на SECRET_REFRESH_SECONDS; відсутні завантажуються паралельно,
+# прострочені оновлюються у фоновому потоці (викликач тим часом отримує попереднє
+# значення). Клієнт Secret Manager створюється лише за потреби.
+_secret_cache = {}
+_secret_refreshing = set()
+_secret_lock = threading.Lock()
+
 def get_secret(secret_id, version_id="latest"):
     try:
         if os.environ.get(secret_id):
             return os.environ.get(secret_id)
 
-        client = secretmanager.SecretManagerServiceClient()
+        client = clients.get("secretmanager")
         name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/{version_id}"
         response = client.access_secret_version(request={"name": name})
         return response.payload.data.decode("UTF-8")
@@ -133,22 +311,194 @@ def get_secret(secret_id, version_id="latest"):
         logger.error(f"Помилка отримання секрету {secret_id}: {e}")
         return None
 
+def _fetch_secrets(secret_ids):
+    now = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=len(secret_ids), thread_name_prefix="secrets") as pool:
+            fetched = list(pool.map(get_secret, secret_ids))
+        with _secret_lock:
+            for secret_id, value in zip(secret_ids, fetched):
+                if value is not None:  # при збої оновлення лишаємо попереднє значення
+                    _secret_cache[secret_id] = (value, now)
+    finally:
+        with _secret_lock:
+            _secret_refreshing.difference_update(secret_ids)
+
+def get_secrets(*secret_ids):
+    """Значення секретів у порядку аргументів (None, якщо секрет недоступний)."""
+    now = time.monotonic()
+    with _secret_lock:
+        missing = [secret_id for secret_id in secret_ids if secret_id not in _secret_cache]
+        stale = [
+            secret_id for secret_id in secret_ids
+            if secret_id in _secret_cache and secret_id not in _secret_refreshing
+            and now - _secret_cache[secret_id][1] > SECRET_REFRESH_SECONDS
+        ]
+        _secret_refreshing.update(stale)
+    if stale:
+        threading.Thread(target=_fetch_secrets, args=(stale,), name="secrets-refresh", daemon=True).start()
+    if missing:
+        _fetch_secrets(missing)
+    with _secret_lock:
+        return [_secret_cache.get(secret_id, (None, None))[0] for secret_id in secret_ids]
+
 # --- 4. ІНІЦІАЛІЗАЦІЯ КЛІЄНТІВ ---
-try:
-    TELEGRAM_TOKEN = get_secret("TELEGRAM_BOT_TOKEN")
-    GEMINI_KEY = get_secret("GEMINI_API_KEY")
-    
-    bot = telegram.Bot(token=TELEGRAM_TOKEN)
-    vision_client = vision.ImageAnnotatorClient()
-    db = firestore.Client(project=PROJECT_ID)
-    
-    genai.configure(api_key=GEMINI_KEY)
-    gemini_model = genai.GenerativeModel(MODEL_NAME)
-    logger.info(f"🚀 Система ініціалізована. Модель: {MODEL_NAME}")
-    
-except Exception as e:
-    logger.critical(f"Critical Error: {e}")
-    bot = None
+# Жоден бекенд не створюється під час імпорту: /start не чекає на Vision,
+# Firestore чи Gemini. Важкі SDK імпортуються всередині фабрик.
+class ClientRegistry:
+    """Лінивий реєстр клієнтів: кожен бекенд створюється під час першого використання.
+
+    Клієнт, зареєстрований із secrets, перебудовується, коли оновлене значення
+    котрогось із цих секретів (ротація токена чи ключа) відрізняється від того,
+    з яким його створено.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._secrets = {}
+        self._clients = {}
+        self._versions = {}
+        self._pinned = set()
+        self._locks = {}
+
+    def register(self, name, factory, secrets=()):
+        self._factories[name] = factory
+        self._secrets[name] = secrets
+        self._locks[name] = threading.Lock()
+
+    def _version(self, name):
+        secrets = self._secrets[name]
+        return tuple(get_secrets(*secrets)) if secrets else None
+
+    def get(self, name):
+        client = self._clients.get(name)
+        if client is not None and (name in self._pinned or self._versions[name] == self._version(name)):
+            return client
+        with self._locks[name]:
+            client = self._clients.get(name)
+            version = self._version(name)
+            if client is None or (name not in self._pinned and self._versions[name] != version):
+                rotated = client is not None
+                start = time.perf_counter()
+                client = self._factories[name]()
+                self._clients[name] = client
+                self._versions[name] = version
+                action = "перебудовано після ротації секрету" if rotated else "ініціалізовано"
+                logger.info(f"🚀 Клієнт {name} {action} за {(time.perf_counter() - start) * 1000:.0f} мс")
+        return client
+
+    def set(self, name, client):
+        """Підміна клієнта (фейкові бекенди в бенчмарках); такий клієнт не перебудовується."""
+        self._clients[name] = client
+        self._pinned.add(name)
+
+    def initialized(self):
+        return sorted(self._clients)
+
+def _create_secretmanager_client():
+    from google.cloud import secretmanager
+    return secretmanager.SecretManagerServiceClient()
+
+class TelegramRequest(HTTPXRequest):
+    """HTTPXRequest, що міряє кожен виклик Bot API (sendMessage, editMessageText, getFile...)."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = "downloadFile" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        with timed("telegram", method=api_method):
+            return await super().do_request(url, method, *args, **kwargs)
+
+def _create_bot():
+    # Ключ Gemini підтягуємо паралельно з токеном — він знадобиться першому ж фото
+    token, _ = get_secrets("TELEGRAM_BOT_TOKEN", "GEMINI_API_KEY")
+    if not token:
+        raise RuntimeError("TELEGRAM_BOT_TOKEN недоступний")
+    return telegram.Bot(token=token, request=TelegramRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+
+def _create_vision_client():
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient()
+
+def _create_firestore_client():
+    from google.cloud import firestore
+    return firestore.Client(project=PROJECT_ID)
+
+def model_settings(profile):
+    """(назва моделі, generation_config) профілю; перевизначення рівнів уже застосовані."""
+    tier, generation_config = MODEL_PROFILES.get(profile, MODEL_PROFILES["custom"])
+    return MODEL_TIERS[tier], generation_config
+
+def system_instruction(profile):
+    if profile in SYSTEM_PROMPTS:
+        instruction = SYSTEM_PROMPTS[profile]
+    elif profile == "map":
+        instruction = MAP_PROMPT
+    else:
+        instruction = CUSTOM_PROMPT
+    return textwrap.dedent(instruction).strip()
+
+class GeminiModels:
+    """Реєстр GenerativeModel: одна модель на профіль команди (рівень, system_instruction, generation_config).
+
+    Інструкція не склеюється з текстом документа в кожному промпті. Якщо вона не коротша
+    за CONTEXT_CACHE_MIN_TOKENS, то кладеться в контекстний кеш Gemini (CachedContent),
+    і запити лише посилаються на нього; модель перебудовується, коли строк кешу спливає.
+    """
+
+    def __init__(self, genai):
+        self.genai = genai
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, profile):
+        with self._lock:
+            model, expires_at = self._models.get(profile, (None, None))
+            if model is None or (expires_at is not None and expires_at < time.monotonic()):
+                model, expires_at = self._build(profile)
+                self._models[profile] = (model, expires_at)
+            return model
+
+    def _build(self, profile):
+        name, generation_config = model_settings(profile)
+        instruction = system_instruction(profile)
+        if CONTEXT_CACHE_ENABLED and estimate_tokens(instruction) >= CONTEXT_CACHE_MIN_TOKENS:
+            ttl = timedelta(minutes=CONTEXT_CACHE_TTL_MINUTES)
+            try:
+                cached = self.genai.caching.CachedContent.create(
+                    model=name, display_name=f"documind-{profile}-{PROMPTS_VERSION}",
+                    system_instruction=instruction, ttl=ttl,
+                )
+                logger.info(f"🚀 Модель {profile}: {name} (контекстний кеш {cached.name})")
+                model = self.genai.GenerativeModel.from_cached_content(cached, generation_config=generation_config)
+                return model, time.monotonic() + ttl.total_seconds() - 60
+            except Exception as e:
+                logger.warning(f"Context Cache Error ({profile}): {e}")
+        logger.info(f"🚀 Модель {profile}: {name}")
+        return self.genai.GenerativeModel(name, system_instruction=instruction, generation_config=generation_config), None
+
+def _create_gemini_models():
+    import google.generativeai as genai
+    gemini_key, = get_secrets("GEMINI_API_KEY")
+    genai.configure(api_key=gemini_key)
+    return GeminiModels(genai)
+
+clients = ClientRegistry()
+clients.register("secretmanager", _create_secretmanager_client)
+clients.register("bot", _create_bot, secrets=("TELEGRAM_BOT_TOKEN",))
+clients.register("vision", _create_vision_client)
+clients.register("firestore", _create_firestore_client)
+clients.register("gemini", _create_gemini_models, secrets=("GEMINI_API_KEY",))
+
+def get_bot():
+    return clients.get("bot")
+
+def get_vision_client():
+    return clients.get("vision")
+
+def get_db():
+    return clients.get("firestore")
+
+def get_gemini_model(profile="custom"):
+    return clients.get("gemini").get(profile)
 
 # --- 5. UI: КЛАВІАТУРИ ---
 
@@ -178,101 +528,1046 @@ def get_direct_response_keyboard():
 
 # --- 6. CORE LOGIC ---
 
-async def real_vision_api(image_bytes):
+# Метрики етапів: таймери й лічильники йдуть у приймач (sink), який можна підмінити.
+# За замовчуванням — структуровані JSON-рядки в stdout (Cloud Logging кладе їх у jsonPayload).
+class MetricsSink:
+    """Інтерфейс приймача метрик."""
+
+    def timing(self, stage, seconds, **labels):
+        pass
+
+    def count(self, name, value=1, **labels):
+        pass
+
+class LoggingMetricsSink(MetricsSink):
+    """Кожен вимір — окремий JSON-рядок у лог."""
+
+    def __init__(self):
+        self._logger = logging.getLogger("documind.metrics")
+        self._logger.propagate = False
+        if not self._logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+        self._logger.setLevel(logging.INFO)
+
+    def timing(self, stage, seconds, **labels):
+        self._logger.info(json.dumps({"metric": "timing", "stage": stage, "ms": round(seconds * 1000, 2), **labels}, ensure_ascii=False))
+
+    def count(self, name, value=1, **labels):
+        self._logger.info(json.dumps({"metric": "count", "name": name, "value": value, **labels}, ensure_ascii=False))
+
+class InMemoryMetricsSink(MetricsSink):
+    """Накопичує виміри в пам'яті (тести, бенчмарки) і рахує p50/p95 по етапах і мітках."""
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def timing(self, stage, seconds, **labels):
+        key = (stage, tuple(sorted(labels.items())))
+        with self._lock:
+            self.timings.setdefault(key, []).append(seconds)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self):
+        """[(етап, мітки, кількість, p50_ms, p95_ms)] для кожної комбінації етапу й міток."""
+        rows = []
+        with self._lock:
+            items = sorted(self.timings.items())
+        for (stage, labels), values in items:
+            ordered = sorted(values)
+            pick = lambda q: ordered[max(0, -(-len(ordered) * q // 100) - 1)] * 1000
+            rows.append((stage, dict(labels), len(ordered), pick(50), pick(95)))
+        return rows
+
+metrics = LoggingMetricsSink() if os.environ.get("METRICS_LOG", "1") == "1" else MetricsSink()
+
+def set_metrics_sink(sink):
+    global metrics
+    metrics = sink
+
+@contextlib.contextmanager
+def timed(stage, **labels):
+    """Вимірює тривалість блоку; мітку status (ok/error) додає автоматично."""
+    start = time.perf_counter()
+    status = "ok"
     try:
-        image = vision.Image(content=image_bytes)
-        response = vision_client.document_text_detection(image=image)
-        if response.error.message: raise Exception(response.error.message)
-        return response.full_text_annotation.text
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        metrics.timing(stage, time.perf_counter() - start, status=status, **labels)
+
+def command_label(command):
+    """Мітка команди для метрик: довільні підписи зводимо до custom, щоб не плодити серії."""
+    return command if command in SYSTEM_PROMPTS else "custom"
+
+def record_gemini_usage(usage, command, prompt, response_text):
+    labels = {"command": command}
+    metrics.count("gemini_prompt_chars", len(prompt), **labels)
+    metrics.count("gemini_response_chars", len(response_text or ""), **labels)
+    if usage is not None:
+        metrics.count("gemini_prompt_tokens", usage.prompt_token_count, **labels)
+        metrics.count("gemini_response_tokens", usage.candidates_token_count, **labels)
+        # Токени, взяті з контекстного кешу (явного або неявного кешування префікса)
+        metrics.count("gemini_cached_tokens", getattr(usage, "cached_content_token_count", 0) or 0, **labels)
+
+_backend_executors = {
+    name: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"{name}-io")
+    for name, limit in BACKEND_CONCURRENCY.items()
+}
+
+async def run_blocking(backend, func, *args, **kwargs):
+    """Виконує синхронний виклик SDK в обмеженому пулі потоків бекенда, не блокуючи event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_backend_executors[backend], functools.partial(func, *args, **kwargs))
+
+def _vision_detect(image_bytes):
+    from google.cloud import vision
+    image = vision.Image(content=image_bytes)
+    return get_vision_client().document_text_detection(image=image)
+
+def _vision_detect_pdf(pdf_bytes):
+    """Синхронний OCR PDF (Vision обробляє перші 5 сторінок файлу)."""
+    from google.cloud import vision
+    request = vision.AnnotateFileRequest(
+        input_config=vision.InputConfig(content=pdf_bytes, mime_type="application/pdf"),
+        features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+    )
+    return get_vision_client().batch_annotate_files(requests=[request]).responses[0]
+
+async def real_vision_api(image_bytes, mime_type="image/jpeg"):
+    metrics.count("vision_upload_bytes", len(image_bytes), mime=mime_type)
+    try:
+        with timed("vision", mime=mime_type):
+            if mime_type == "application/pdf":
+                response = await run_blocking("vision", _vision_detect_pdf, image_bytes)
+                if response.error.message: raise Exception(response.error.message)
+                pages = [page.full_text_annotation.text for page in response.responses]
+                if len(pages) == 1:
+                    return pages[0]
+                return "\n\n".join(f"--- Сторінка {n} ---\n{text}" for n, text in enumerate(pages, 1) if text)
+            response = await run_blocking("vision", _vision_detect, image_bytes)
+            if response.error.message: raise Exception(response.error.message)
+            return response.full_text_annotation.text
     except Exception as e:
         logger.error(f"Vision API Failed: {e}")
         return None
 
-async def real_gemini_api(text, command):
-    try:
-        if command in SYSTEM_PROMPTS:
-            system_instruction = SYSTEM_PROMPTS[command]
-        else:
-            system_instruction = f"Ти корисний асистент. Проаналізуй документ згідно з запитом користувача: '{command}'. \nВАЖЛИВО: Використовуй тільки одинарні зірочки (*) для жирного шрифту."
+async def stream_gemini_api(prompt, on_chunk, command="custom", profile=None):
+    """Споживає стрім Gemini у пулі потоків і передає накопичений текст в on_chunk."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    usage = None
+    first_chunk_at = None
+    start = time.perf_counter()
 
-        full_prompt = f"{system_instruction}\n\n=== ТЕКСТ ДОКУМЕНТА ===\n{text}\n======================="
-        response = gemini_model.generate_content(full_prompt)
-        
-        clean_text = response.text.replace("**", "*") 
-        return clean_text
+    def consume():
+        nonlocal usage
+        try:
+            for chunk in get_gemini_model(profile or command).generate_content(prompt, stream=True):
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                try:
+                    piece = chunk.text
+                except ValueError:
+                    continue  # службовий чанк без тексту (finish_reason тощо)
+                loop.call_soon_threadsafe(queue.put_nowait, piece)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    worker = loop.run_in_executor(_backend_executors["gemini"], consume)
+    parts = []
+    while (piece := await queue.get()) is not None:
+        if first_chunk_at is None:
+            first_chunk_at = time.perf_counter()
+            metrics.timing("gemini_first_chunk", first_chunk_at - start, command=command)
+        parts.append(piece)
+        await on_chunk("".join(parts).replace("**", "*"))
+    await worker  # прокидає помилку з потоку, якщо стрім обірвався
+    result = "".join(parts)
+    record_gemini_usage(usage, command, prompt, result)
+    if not result.strip():
+        # Як і response.text без стріму: заблокована відповідь — помилка, а не порожній текст
+        raise ValueError("Gemini stream returned no text")
+    return result
+
+async def gemini_generate(prompt, on_chunk=None, command="custom", profile=None):
+    """Один виклик моделі профілю (за замовчуванням — профіль команди): звичайний або стрімінговий."""
+    profile = profile or command
+    with timed("gemini_call", command=command, profile=profile, stream=on_chunk is not None):
+        if on_chunk is None:
+            response = await run_blocking("gemini", lambda: get_gemini_model(profile).generate_content(prompt))
+            record_gemini_usage(getattr(response, "usage_metadata", None), command, prompt, response.text)
+            return response.text
+        return await stream_gemini_api(prompt, on_chunk, command, profile)
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _split_oversized(block, max_chars):
+    """Ділить завеликий абзац по рядках, а надто довгі рядки — жорстко по символах."""
+    pieces, current = [], ""
+    for line in block.splitlines():
+        while len(line) > max_chars:
+            pieces.append(line[:max_chars])
+            line = line[max_chars:]
+        if current and len(current) + len(line) + 1 > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        pieces.append(current)
+    return pieces
+
+def split_into_chunks(text, max_tokens=CHUNK_TOKENS):
+    """Фрагменти тексту в межах бюджету токенів; межі — по абзацах і сторінках."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    blocks = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if paragraph:
+            blocks.extend(_split_oversized(paragraph, max_chars) if len(paragraph) > max_chars else [paragraph])
+
+    chunks, current = [], ""
+    for block in blocks:
+        # Нова сторінка альбому — природна межа, якщо поточний фрагмент уже наполовину заповнений
+        page_break = block.startswith("--- Сторінка ") and len(current) > max_chars // 2
+        if current and (page_break or len(current) + len(block) + 2 > max_chars):
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{block}" if current else block
+    if current:
+        chunks.append(current)
+    return chunks
+
+def build_prompt(command, text, note=None):
+    """Вміст запиту; статична інструкція команди — у system_instruction її моделі (GeminiModels)."""
+    parts = []
+    if command not in SYSTEM_PROMPTS:
+        parts.append(f"ЗАПИТ КОРИСТУВАЧА: '{command}'")
+    if note:
+        parts.append(note)
+    parts.append(f"=== ТЕКСТ ДОКУМЕНТА ===\n{text}\n=======================")
+    return "\n\n".join(parts)
+
+async def map_reduce_generate(text, command, generate, on_chunk=None, max_tokens=CHUNK_TOKENS, concurrency=MAP_CONCURRENCY,
+                              map_generate=None):
+    """Map: витяг фактів з кожного фрагмента паралельно (не більше concurrency). Reduce: команда над витягами.
+
+    `generate(prompt, on_chunk)` — корутина виклику моделі, тож рушій працює і з фейковою моделлю.
+    `map_generate` — виклик моделі з інструкцією MAP_PROMPT для map-етапу (за замовчуванням generate).
+    """
+    map_generate = map_generate or generate
+    chunks = split_into_chunks(text, max_tokens)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def map_chunk(number, chunk):
+        async with semaphore:
+            prompt = f"=== ФРАГМЕНТ {number} З {len(chunks)} ===\n{chunk}\n================"
+            return await map_generate(prompt, None)
+
+    partials = await asyncio.gather(*(map_chunk(number, chunk) for number, chunk in enumerate(chunks, 1)))
+    digest = "\n\n".join(f"=== ФРАГМЕНТ {number} ===\n{partial.strip()}" for number, partial in enumerate(partials, 1))
+    logger.info(f"Map-reduce {command}: {len(chunks)} фрагментів, {len(text)} -> {len(digest)} символів")
+    return await generate(build_prompt(command, digest, note=REDUCE_NOTE), on_chunk)
+
+async def real_gemini_api(text, command, on_chunk=None):
+    """Аналіз тексту Gemini. Якщо передано on_chunk — відповідь стрімиться частинами.
+
+    Довгі документи для MAP_REDUCE_COMMANDS обробляються через map_reduce_generate,
+    довільні запити до довгих документів — через retrieval_generate.
+    """
+    label = command_label(command)
+    generate = functools.partial(gemini_generate, command=label)
+    try:
+        with timed("gemini", command=label):
+            if command in MAP_REDUCE_COMMANDS and estimate_tokens(text) > CHUNK_TOKENS:
+                map_generate = functools.partial(gemini_generate, command=label, profile="map")
+                raw_text = await map_reduce_generate(text, command, generate, on_chunk=on_chunk, map_generate=map_generate)
+            elif command not in SYSTEM_PROMPTS and estimate_tokens(text) > RETRIEVAL_MIN_TOKENS:
+                raw_text = await retrieval_generate(text, command, generate, on_chunk=on_chunk)
+            else:
+                raw_text = await generate(build_prompt(command, text), on_chunk)
+        return raw_text
     except Exception as e:
         logger.error(f"Gemini API Failed: {e}")
-        return "⚠️ Помилка AI."
+        return AI_ERROR_MESSAGE
 
-def save_to_cache(chat_id, message_id, text):
+def _firestore_get(collection, doc_id):
+    with timed("firestore_get", collection=collection):
+        return get_db().collection(collection).document(doc_id).get()
+
+def _firestore_commit(items):
+    """Записує [((collection, doc_id), data), ...] batch-ами (не більше FIRESTORE_BATCH_LIMIT у кожному)."""
+    from google.cloud import firestore
+    db = get_db()
+    with timed("firestore_commit"):
+        for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+            batch = db.batch()
+            for (collection, doc_id), data in items[start:start + FIRESTORE_BATCH_LIMIT]:
+                batch.set(db.collection(collection).document(doc_id), {**data, "created_at": firestore.SERVER_TIMESTAMP})
+            batch.commit()
+    metrics.count("firestore_writes", len(items))
+
+class BatchWriter:
+    """Відкладені записи у Firestore поза критичним шляхом відповіді.
+
+    put() лише ставить документ у чергу; через CACHE_WRITE_DELAY секунд (або коли
+    черга досягне max_batch) усі накопичені записи комітяться одним batch.
+    Повторний запис того самого документа до коміту замінює попередній.
+    """
+
+    def __init__(self, delay, max_batch):
+        self.delay = delay
+        self.max_batch = max_batch
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+        self._tasks = set()
+
+    def put(self, collection, doc_id, data):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._pending[(collection, doc_id)] = data
+            full = len(self._pending) >= self.max_batch
+            if not full and self._timer is None:
+                self._timer = loop.call_later(self.delay, self._spawn_flush, loop)
+        if full:
+            self._spawn_flush(loop)
+
+    def _spawn_flush(self, loop):
+        task = loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        with self._lock:
+            items, self._pending = list(self._pending.items()), {}
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        if not items:
+            return
+        try:
+            await run_blocking("firestore", _firestore_commit, items)
+        except Exception as e:
+            logger.error(f"Firestore Batch Error ({len(items)} docs): {e}")
+
+cache_writes = BatchWriter(CACHE_WRITE_DELAY, CACHE_WRITE_BATCH)
+
+def pack_value(value):
+    """Поля документа кешу: великий текст стискається zlib у `value_z`, малий лишається у `value`."""
+    encoded = value.encode("utf-8")
+    if len(encoded) >= CACHE_COMPRESS_MIN_BYTES:
+        return {"value_z": zlib.compress(encoded, 6)}
+    return {"value": value}
+
+def unpack_value(data):
+    """Зворотне до pack_value; старі документи кешу зберігали текст у полі `text`."""
+    if data.get("value_z") is not None:
+        return zlib.decompress(data["value_z"]).decode("utf-8")
+    if data.get("value") is not None:
+        return data["value"]
+    return data.get("text")
+
+class LRUCache:
+    """Потокобезпечний LRU-кеш у пам'яті процесу з необов'язковим TTL (секунди).
+
+    Витіснення — за кількістю записів (max_items) та/або за сумарним розміром
+    значень (max_size, розмір рахує `sizeof`, за замовчуванням len).
+    """
+
+    def __init__(self, max_items=None, ttl=None, max_size=None, sizeof=len):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at, _ = item
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        size = self.sizeof(value) if self.max_size else 0
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self.size += size
+            while self._data and (
+                (self.max_items is not None and len(self._data) > self.max_items)
+                or (self.max_size is not None and self.size > self.max_size)
+            ):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key):
+        with self._lock:
+            item = self._remove(key)
+        return item[0] if item is not None else None
+
+    def values(self):
+        """Знімок незастарілих значень."""
+        now = time.monotonic()
+        with self._lock:
+            return [value for value, expires_at, _ in self._data.values() if expires_at is None or expires_at >= now]
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= item[2]
+        return item
+
+class TwoTierCache:
+    """Дворівневий кеш: LRU у пам'яті (теплий інстанс) + колекція Firestore з TTL.
+
+    Поле `expires_at` варто підключити до TTL-політики Firestore, щоб старі
+    документи видалялися автоматично; при читанні строк перевіряється додатково.
+    """
+
+    def __init__(self, collection, ttl, max_items=None, max_size=None, writer=None):
+        self.collection = collection
+        self.ttl = ttl
+        self.local = LRUCache(max_items, ttl=ttl.total_seconds(), max_size=max_size)
+        self.writer = writer or cache_writes
+
+    async def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            metrics.count("cache", cache=self.collection, result="memory")
+            return value
+        try:
+            doc = await run_blocking("firestore", _firestore_get, self.collection, key)
+            data = doc.to_dict() if doc.exists else {}
+            expires_at = data.get("expires_at")
+            if expires_at is not None and expires_at < datetime.now(timezone.utc):
+                data = {}
+            value = unpack_value(data)
+            metrics.count("cache", cache=self.collection, result="miss" if value is None else "firestore")
+            if value is not None:
+                self.local.set(key, value)
+            return value
+        except Exception as e:
+            logger.error(f"Cache Get Error ({self.collection}): {e}")
+            return None
+
+    async def set(self, key, value):
+        """Значення одразу доступне з пам'яті; запис у Firestore іде через BatchWriter."""
+        self.local.set(key, value)
+        self.writer.put(self.collection, key, {
+            **pack_value(value),
+            "expires_at": datetime.now(timezone.utc) + self.ttl,
+        })
+
+ocr_results_cache = TwoTierCache(OCR_CACHE_COLLECTION, timedelta(days=OCR_CACHE_TTL_DAYS), max_items=OCR_CACHE_LRU_SIZE)
+session_cache = TwoTierCache(
+    SESSION_CACHE_COLLECTION, timedelta(hours=SESSION_CACHE_TTL_HOURS), max_size=SESSION_CACHE_MAX_CHARS,
+)
+
+async def save_to_cache(chat_id, message_id, text):
+    await session_cache.set(f"{chat_id}_{message_id}", text)
+
+async def get_from_cache(chat_id, message_id):
+    return await session_cache.get(f"{chat_id}_{message_id}")
+
+def pick_photo_size(sizes):
+    """Найменший варіант фото, довша сторона якого не менша за OCR_TARGET_SIDE (інакше найбільший)."""
+    ordered = sorted(sizes, key=lambda size: size.width * size.height)
+    for size in ordered:
+        if max(size.width, size.height) >= OCR_TARGET_SIDE:
+            return size
+    return ordered[-1]
+
+def preprocess_image(image_bytes, max_side=OCR_MAX_SIDE, quality=OCR_JPEG_QUALITY):
+    """Зменшує завеликі зображення, переводить майже ч/б у відтінки сірого і перестискає в JPEG.
+
+    Повертає менший з варіантів (оригінал або оброблений). Pillow — необов'язкова
+    залежність: без неї байти передаються у Vision як є.
+    """
     try:
-        doc_ref = db.collection("ocr_cache").document(f"{chat_id}_{message_id}")
-        doc_ref.set({"text": text, "created_at": firestore.SERVER_TIMESTAMP})
+        from PIL import Image, ImageOps, ImageStat
+    except ImportError:
+        return image_bytes
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            # Орієнтацію з EXIF застосовуємо до пікселів: після перестискання тегу вже не буде
+            img = ImageOps.exif_transpose(img)
+            if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+                # Прозорий PNG із чорним текстом без білого тла став би суцільно чорним
+                rgba = img.convert("RGBA")
+                img = Image.new("RGB", rgba.size, "white")
+                img.paste(rgba, mask=rgba.getchannel("A"))
+            img = img.convert("RGB")
+            if max(img.size) > max_side:
+                scale = max_side / max(img.size)
+                img = img.resize((round(img.width * scale), round(img.height * scale)), Image.LANCZOS)
+            thumbnail = img.copy()
+            thumbnail.thumbnail((64, 64))
+            saturation = ImageStat.Stat(thumbnail.convert("HSV").getchannel("S")).mean[0]
+            if saturation < GRAYSCALE_SATURATION:
+                img = img.convert("L")
+            output = io.BytesIO()
+            img.save(output, format="JPEG", quality=quality, optimize=True)
     except Exception as e:
-        logger.error(f"Firestore Save Error: {e}")
+        logger.warning(f"Image Preprocess Error: {e}")
+        return image_bytes
+    processed = output.getvalue()
+    return processed if len(processed) < len(image_bytes) else image_bytes
+
+def get_ocr_media(message):
+    """(об'єкт файлу, MIME-тип) для OCR: оптимальний PhotoSize фото або документ-файл."""
+    if message.photo:
+        return pick_photo_size(message.photo), "image/jpeg"
+    return message.document, message.document.mime_type
+
+def is_supported_document(message):
+    document = message.document
+    return document is not None and document.mime_type in SUPPORTED_DOCUMENT_TYPES
+
+async def recognize_file(media, mime_type="image/jpeg"):
+    """OCR з кешем: спершу за file_unique_id (без завантаження), потім за SHA-256 байтів."""
+    uid_key = f"uid_{media.file_unique_id}"
+    text = await ocr_results_cache.get(uid_key)
+    if text is not None:
+        logger.info(f"OCR cache hit: {uid_key}")
+        return text
+
+    tg_file = await media.get_file()
+    image_bytes = bytes(await tg_file.download_as_bytearray())
+    metrics.count("telegram_download_bytes", len(image_bytes), mime=mime_type)
+    hash_key = f"sha_{hashlib.sha256(image_bytes).hexdigest()}"
+    text = await ocr_results_cache.get(hash_key)
+    if text is None:
+        if mime_type.startswith("image/"):
+            original_size = len(image_bytes)
+            image_bytes = await run_blocking("imaging", preprocess_image, image_bytes)
+            logger.info(f"Image preprocess: {original_size} -> {len(image_bytes)} bytes")
+            mime_type = "image/jpeg"
+        text = await real_vision_api(image_bytes, mime_type)
+        if not text:
+            return text
+        await asyncio.gather(ocr_results_cache.set(hash_key, text), ocr_results_cache.set(uid_key, text))
+    else:
+        logger.info(f"OCR cache hit: {hash_key}")
+        await ocr_results_cache.set(uid_key, text)
+    return text
+
+async def recognize_pages(media_list):
+    """OCR багатосторінкового документа: сторінки [(media, mime_type)] розпізнаються паралельно і склеюються по порядку."""
+    texts = await asyncio.gather(*(recognize_file(media, mime_type) for media, mime_type in media_list))
+    if len(media_list) == 1:
+        return texts[0]
+    pages = [f"--- Сторінка {number} ---\n{text}" for number, text in enumerate(texts, 1) if text]
+    return "\n\n".join(pages) or None
+
+# Альбом збирається в документі media_groups/{media_group_id}: перша сторінка атомарно
+# створює документ і стає власником групи, решта дописують себе в поле pages і одразу
+# завершуються. Власник чекає, доки MEDIA_GROUP_WINDOW секунд не з'явиться нових сторінок,
+# і закриває групу (claimed). Записи сторінок і закриття йдуть з передумовою
+# last_update_time, тож сторінка або потрапляє в альбом, або бачить його закритим.
+# Сторінка, що запізнилася, відкриває наступне покоління групи ({media_group_id}~N).
+def _media_group_doc(doc_id):
+    return get_db().collection(MEDIA_GROUP_COLLECTION).document(doc_id)
+
+def _media_group_register(group_id, message):
+    """Записує сторінку в документ альбому. Повертає (id документа, чи ця сторінка — власник групи)."""
+    from google.api_core import exceptions
+    page_key, page = f"m{message.message_id}", message.to_dict()
+    with timed("media_group_register"):
+        for generation in itertools.count():
+            doc_id = group_id if generation == 0 else f"{group_id}~{generation}"
+            doc = _media_group_doc(doc_id)
+            while True:
+                try:
+                    doc.create({
+                        "owner": message.message_id,
+                        "pages": {page_key: page},
+                        "last_seen": time.time(),
+                        "claimed": False,
+                        "expires_at": datetime.now(timezone.utc) + timedelta(hours=MEDIA_GROUP_TTL_HOURS),
+                    })
+                    return doc_id, True
+                except exceptions.AlreadyExists:
+                    pass
+                snapshot = doc.get()
+                data = snapshot.to_dict()
+                if data is None:
+                    continue  # документ щойно видалено за TTL
+                if page_key in data["pages"]:
+                    # Повторна доставка: перша сторінка знову стає власником і збирає весь альбом
+                    return doc_id, data["owner"] == message.message_id
+                if data["claimed"]:
+                    break  # власник уже забрав альбом — сторінка йде в наступне покоління
+                try:
+                    doc.update(
+                        {f"pages.{page_key}": page, "last_seen": time.time()},
+                        option=get_db().write_option(last_update_time=snapshot.update_time),
+                    )
+                    return doc_id, False
+                except exceptions.FailedPrecondition:
+                    continue  # документ змінився між читанням і записом
+
+def _media_group_claim(doc_id):
+    """Закриває групу, якщо нових сторінок не було MEDIA_GROUP_WINDOW секунд.
 
-def get_from_cache(chat_id, message_id):
+    Повертає (сторінки, 0) або (None, скільки ще чекати).
+    """
+    from google.api_core import exceptions
+    doc = _media_group_doc(doc_id)
+    while True:
+        snapshot = doc.get()
+        data = snapshot.to_dict()
+        if data["claimed"]:
+            return data["pages"], 0  # повторна доставка після збою: склад альбому вже остаточний
+        delay = data["last_seen"] + MEDIA_GROUP_WINDOW - time.time()
+        if delay > 0:
+            return None, delay
+        try:
+            doc.update({"claimed": True}, option=get_db().write_option(last_update_time=snapshot.update_time))
+            return data["pages"], 0
+        except exceptions.FailedPrecondition:
+            continue  # щойно дописалася сторінка
+
+async def collect_media_group(message):
+    """Збирає сторінки альбому. Власник групи (перша сторінка) отримує всі сторінки, решта — None.
+
+    Якщо Firestore недоступний, сторінки збираються лише в межах цього інстансу.
+    """
     try:
-        doc_ref = db.collection("ocr_cache").document(f"{chat_id}_{message_id}")
-        doc = doc_ref.get()
-        if doc.exists:
-            return doc.to_dict().get("text")
+        doc_id, owner = await run_blocking("firestore", _media_group_register, message.media_group_id, message)
+        if not owner:
+            return None
+        pages, delay = None, MEDIA_GROUP_WINDOW
+        while pages is None:
+            await asyncio.sleep(delay)
+            pages, delay = await run_blocking("firestore", _media_group_claim, doc_id)
+    except Exception as e:
+        logger.error(f"Media Group Error: {e}")
+        return await collect_media_group_locally(message)
+    messages = [telegram.Message.de_json(page, get_bot()) for page in pages.values()]
+    return sorted(messages, key=lambda m: m.message_id)
+
+# Запасний буфер в пам'яті: media_group_id -> {"messages": [...], "deadline": ...}.
+# Усі апдейти обробляються в одному event loop, тож блокування не потрібне.
+_media_groups = {}
+
+async def collect_media_group_locally(message):
+    """Буферизує сторінки альбому в межах інстансу. Перший апдейт групи отримує всі сторінки, решта — None."""
+    group_id = message.media_group_id
+    group = _media_groups.get(group_id)
+    if group is not None:
+        group["messages"].append(message)
+        group["deadline"] = time.monotonic() + MEDIA_GROUP_WINDOW
         return None
+
+    group = {"messages": [message], "deadline": time.monotonic() + MEDIA_GROUP_WINDOW}
+    _media_groups[group_id] = group
+    while (delay := group["deadline"] - time.monotonic()) > 0:
+        await asyncio.sleep(delay)
+    del _media_groups[group_id]
+    return sorted(group["messages"], key=lambda m: m.message_id)
+
+ai_results_cache = TwoTierCache(AI_CACHE_COLLECTION, timedelta(days=AI_CACHE_TTL_DAYS), max_items=AI_CACHE_LRU_SIZE)
+
+def ai_result_key(text, command):
+    profiles = [command_label(command)]
+    if command in MAP_REDUCE_COMMANDS:
+        profiles.append("map")  # довгі документи проходять ще й через map-модель
+    models = json.dumps([model_settings(profile) for profile in profiles], sort_keys=True)
+    payload = "\x1f".join([PROMPTS_VERSION, models, command, text])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def lookup_ai_result(text, command):
+    """Готова відповідь Gemini з кешу або None."""
+    return await ai_results_cache.get(ai_result_key(text, command))
+
+async def generate_ai_result(text, command, on_chunk=None):
+    """Виклик Gemini зі збереженням успішної відповіді в кеш."""
+    result = await real_gemini_api(text, command, on_chunk=on_chunk)
+    if result != AI_ERROR_MESSAGE and result.strip():
+        await ai_results_cache.set(ai_result_key(text, command), result)
+    return result
+
+async def get_ai_result(text, command, on_chunk=None):
+    """real_gemini_api з кешем: повторна дія над тим самим текстом не витрачає квоту."""
+    result = await lookup_ai_result(text, command)
+    if result is not None:
+        logger.info(f"AI cache hit: {command}")
+        return result
+    return await generate_ai_result(text, command, on_chunk=on_chunk)
+
+# Стоп-слова запитів: без них BM25 не віддає перевагу уривкам зі словами "що", "як" тощо
+STOP_WORDS = frozenset(
+    "а але в во де для до з за і із й же коли на не ну о про та те то у чи що як який яка яке які це цей ця ці "
+    "мені мій є було буде там тут так його її їх ми ви вони він вона воно скільки чому хто де куди "
+    "a an and are as at be by for from how in is it of on or the to what when where which who why with".split()
+)
+
+def tokenize(text):
+    """Слова в нижньому регістрі; довгі слова обрізаються до 6 літер — грубий стемінг для відмінків."""
+    return [word if word.isdigit() else word[:6] for word in re.findall(r"\w+", text.lower()) if word not in STOP_WORDS]
+
+class PassageIndex:
+    """BM25 за уривками одного документа (межі — абзаци, сторінки і бюджет PASSAGE_TOKENS)."""
+
+    def __init__(self, text, passage_tokens=PASSAGE_TOKENS, k1=1.5, b=0.75):
+        self.text = text
+        self.passages = split_into_chunks(text, passage_tokens)
+        self.k1 = k1
+        self.b = b
+        self.terms = [Counter(tokenize(passage)) for passage in self.passages]
+        self.lengths = [sum(terms.values()) for terms in self.terms]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        document_frequency = Counter(term for terms in self.terms for term in terms)
+        total = len(self.passages)
+        self.idf = {term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+
+    def scores(self, query):
+        query_terms = set(tokenize(query)) & self.idf.keys()
+        scores = []
+        for terms, length in zip(self.terms, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self.average_length or 1))
+            scores.append(sum(
+                self.idf[term] * terms[term] * (self.k1 + 1) / (terms[term] + norm)
+                for term in query_terms if term in terms
+            ))
+        return scores
+
+    def select(self, query, top_k=RETRIEVAL_TOP_K, max_share=RETRIEVAL_MAX_SHARE):
+        """Найкращі уривки в порядку документа або None, якщо краще надіслати повний текст."""
+        scores = self.scores(query)
+        ranked = [i for i in sorted(range(len(scores)), key=scores.__getitem__, reverse=True) if scores[i] > 0][:top_k]
+        if not ranked:
+            return None  # жодне слово запиту не трапляється в документі
+        selected = "\n\n[...]\n\n".join(self.passages[i] for i in sorted(ranked))
+        if len(selected) > len(self.text) * max_share:
+            return None
+        return selected
+
+_passage_indexes = LRUCache(PASSAGE_INDEX_CACHE_SIZE)
+
+def get_passage_index(text):
+    """Індекс документа будується один раз і лишається в пам'яті для наступних запитів до нього."""
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    index = _passage_indexes.get(key)
+    if index is None:
+        with timed("passage_index"):
+            index = PassageIndex(text)
+        _passage_indexes.set(key, index)
+    return index
+
+def _hide_no_answer(on_chunk):
+    """Не показує користувачу стрім, поки він може виявитися маркером NO_ANSWER."""
+    if on_chunk is None:
+        return None
+    async def forward(text):
+        if not NO_ANSWER.startswith(text.lstrip()[:len(NO_ANSWER)]):
+            await on_chunk(text)
+    return forward
+
+async def retrieval_generate(text, command, generate, on_chunk=None):
+    """Довільний запит до довгого документа: спершу за найрелевантнішими уривками, за потреби — повний текст."""
+    passages = get_passage_index(text).select(command)
+    if passages is not None:
+        answer = await generate(build_prompt(command, passages, note=RETRIEVAL_NOTE), _hide_no_answer(on_chunk))
+        if not answer.strip().startswith(NO_ANSWER):
+            metrics.count("retrieval", result="passages")
+            logger.info(f"Retrieval: {len(text)} -> {len(passages)} символів")
+            return answer
+        metrics.count("retrieval", result="fallback")
+    else:
+        metrics.count("retrieval", result="full_text")
+    return await generate(build_prompt(command, text), on_chunk)
+
+# Спекулятивний prefetch: задачі в польоті за ключем результату та очікувані
+# команди для кожного меню (chat_id, message_id) — для підрахунку влучань.
+_prefetch_tasks = {}
+_prefetch_menus = LRUCache(1024, ttl=3600)
+PREFETCH_STATS = {"started": 0, "skipped": 0, "hits": 0, "misses": 0, "cancelled": 0, "failed": 0}
+
+def _prefetch_stat(outcome, value=1):
+    PREFETCH_STATS[outcome] += value
+    metrics.count("prefetch", value, outcome=outcome)
+
+def prefetch_hit_rate():
+    decided = PREFETCH_STATS["hits"] + PREFETCH_STATS["misses"]
+    return PREFETCH_STATS["hits"] / decided if decided else 0.0
+
+async def _prefetch(text, command):
+    try:
+        result = await asyncio.wait_for(get_ai_result(text, command), PREFETCH_TIMEOUT)
+        if result == AI_ERROR_MESSAGE:
+            _prefetch_stat("failed")
+        return result
+    except asyncio.CancelledError:
+        _prefetch_stat("cancelled")
+        raise
     except Exception as e:
-        logger.error(f"Firestore Get Error: {e}")
+        _prefetch_stat("failed")
+        logger.warning(f"Prefetch Error ({command}): {e}")
         return None
 
-# --- 7. HELPER: SAFE SENDING ---
+def schedule_prefetch(chat_id, message_id, text):
+    """Запускає PREFETCH_COMMANDS у фоні для щойно показаного меню (в межах бюджету)."""
+    if not PREFETCH_COMMANDS:
+        return
+    if len(text) > PREFETCH_MAX_CHARS:
+        _prefetch_stat("skipped", len(PREFETCH_COMMANDS))
+        return
+
+    keys = {}
+    for command in PREFETCH_COMMANDS:
+        key = ai_result_key(text, command)
+        if key not in _prefetch_tasks:
+            if len(_prefetch_tasks) >= PREFETCH_MAX_INFLIGHT:
+                _prefetch_stat("skipped")
+                continue
+            task = asyncio.create_task(_prefetch(text, command))
+            task.add_done_callback(lambda _, key=key: _prefetch_tasks.pop(key, None))
+            _prefetch_tasks[key] = task
+            _prefetch_stat("started")
+        keys[command] = key
+    if keys:
+        _prefetch_menus.set((chat_id, message_id), keys)
 
-async def safe_edit_message(query, text, reply_markup):
+def _release_prefetch(keys):
+    """Скасовує задачі prefetch меню, на які не посилається жодне інше живе меню (той самий текст)."""
+    still_needed = {key for menu_keys in _prefetch_menus.values() for key in menu_keys.values()}
+    for key in keys.values():
+        task = _prefetch_tasks.get(key)
+        if task is not None and key not in still_needed:
+            task.cancel()
+
+def cancel_prefetch(chat_id, message_id):
+    _release_prefetch(_prefetch_menus.pop((chat_id, message_id)) or {})
+
+async def take_prefetched_result(chat_id, message_id, command, on_wait=None):
+    """Перша дія в меню: фіксує влучання/промах prefetch і чекає задачу, якщо вона ще в польоті.
+
+    `on_wait()` викликається перед очікуванням задачі, щоб показати користувачу статус.
+    """
+    keys = _prefetch_menus.pop((chat_id, message_id))
+    if keys is None:
+        return None
+    if command not in keys:
+        _prefetch_stat("misses")
+        logger.info(f"Prefetch miss: {command}, hit rate {prefetch_hit_rate():.0%}")
+        _release_prefetch(keys)  # вгадали не ту дію — звільняємо бюджет
+        return None
+
+    _prefetch_stat("hits")
+    logger.info(f"Prefetch hit: {command}, hit rate {prefetch_hit_rate():.0%}")
+    task = _prefetch_tasks.get(keys[command])
+    if task is None:
+        return None  # уже завершено — результат чекає в кеші відповідей
+    if on_wait is not None and not task.done():
+        await on_wait()
     try:
-        await query.edit_message_text(
-            text=text,
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
-    except telegram.error.BadRequest as e:
-        if "Can't parse entities" in str(e):
-            logger.warning(f"Markdown Error: {e}")
-            await query.edit_message_text(
-                text=text + "\n\n_(⚠️ Форматування вимкнено через помилку в символах)_",
-                reply_markup=reply_markup,
-                parse_mode=None 
-            )
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if task.cancelled():
+            return None
+        raise
+
+# --- 7. FORMATTING ---
+# Текст Gemini (легкий Markdown) і сирий текст OCR перетворюються на HTML Telegram
+# локально, за один прохід: усе, що не стало тегом, екранується, а теги відкриваються
+# і закриваються в межах одного рядка. Тому Telegram завжди приймає розмітку з першої
+# спроби і повторна відправка без форматування не потрібна.
+
+PARSE_MODE = "HTML"
+
+_INLINE_MARKDOWN = re.compile(
+    r"`(?P<code>[^`\n]+)`"
+    r"|\*\*(?=\S)(?P<bold>.+?)(?<=\S)\*\*"
+    r"|\*(?=[^\s*])(?P<strong>[^*\n]+?)(?<=[^\s*])\*"
+    r"|(?<!\w)_(?=[^\s_])(?P<italic>[^_\n]+?)(?<=[^\s_])_(?!\w)"
+)
+_FENCE = re.compile(r"^\s*```[\w+#.-]*\s*$")
+_HEADING = re.compile(r"^\s{0,3}#{1,6}\s+(.*?)\s*#*\s*$")
+_BULLET = re.compile(r"^(\s*)[*\-+]\s+")
+
+def escape_html(text):
+    return html.escape(text, quote=False)
+
+def render_inline(line):
+    """Один рядок Markdown -> HTML: `код`, **жирний**, *жирний*, _курсив_; решта екранується."""
+    parts, position = [], 0
+    for match in _INLINE_MARKDOWN.finditer(line):
+        parts.append(escape_html(line[position:match.start()]))
+        if match["code"] is not None:
+            parts.append(f"<code>{escape_html(match['code'])}</code>")
+        elif match["italic"] is not None:
+            parts.append(f"<i>{escape_html(match['italic'])}</i>")
         else:
-            raise e
+            parts.append(f"<b>{escape_html(match['bold'] or match['strong'])}</b>")
+        position = match.end()
+    parts.append(escape_html(line[position:]))
+    return "".join(parts)
+
+def render_markdown_line(line):
+    heading = _HEADING.match(line)
+    if heading:
+        return f"<b>{escape_html(heading.group(1))}</b>"
+    bullet = _BULLET.match(line)
+    if bullet:
+        return bullet.group(1) + "• " + render_inline(line[bullet.end():])
+    return render_inline(line)
+
+def render_markdown(text):
+    """Короткі службові тексти (заголовки, статуси) у Markdown -> HTML без розбиття."""
+    return "\n".join(render_markdown_line(line) for line in text.split("\n"))
+
+def _line_pieces(line, limit):
+    """Розбиває задовгий рядок на шматки не довші за limit, по можливості на пробілах."""
+    while len(line) > limit:
+        cut = line.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        yield line[:cut]
+        line = line[cut:].lstrip(" ")
+    yield line
+
+def markdown_blocks(text, limit):
+    """Блоки (обгортка, html, видима довжина) для відповіді Gemini; ``` стає <pre>."""
+    in_fence = False
+    for line in text.strip("\n").split("\n"):
+        if _FENCE.match(line):
+            in_fence = not in_fence
+            continue
+        for piece in _line_pieces(line, limit):
+            if in_fence:
+                yield "pre", escape_html(piece), len(piece)
+            else:
+                yield None, render_markdown_line(piece), len(piece)
+
+def plain_blocks(text, limit):
+    """Блоки для сирого тексту OCR: без розмітки, моноширинно в <pre>."""
+    for line in text.strip("\n").split("\n"):
+        for piece in _line_pieces(line, limit):
+            yield "pre", escape_html(piece), len(piece)
+
+def _join_blocks(blocks):
+    chunks = []
+    for wrap, group in itertools.groupby(blocks, key=lambda block: block[0]):
+        body = "\n".join(line for _, line in group)
+        chunks.append(f"<pre>{body}</pre>" if wrap == "pre" else body)
+    return "\n".join(chunks)
+
+def pack_messages(blocks, limit=MAX_MESSAGE_LENGTH):
+    """Складає блоки в повідомлення не довші за limit видимих символів.
+
+    Межі повідомлень проходять лише між рядками, тож жоден тег не розривається;
+    блок <pre> на межі закривається і відкривається знову в наступному повідомленні.
+    """
+    messages, current, size = [], [], 0
+    for wrap, line, length in blocks:
+        if current and size + length > limit:
+            messages.append(_join_blocks(current))
+            current, size = [], 0
+        current.append((wrap, line))
+        size += length + 1
+    if current:
+        messages.append(_join_blocks(current))
+    return messages
+
+def format_markdown(text, limit=MAX_MESSAGE_LENGTH):
+    """Відповідь Gemini -> список HTML-повідомлень."""
+    return pack_messages(markdown_blocks(text, limit), limit)
+
+def format_plain(text, limit=MAX_MESSAGE_LENGTH):
+    """Сирий текст OCR -> список HTML-повідомлень."""
+    return pack_messages(plain_blocks(text, limit), limit)
 
-async def send_smart_response(chat_id, text, reply_markup=None, caption_msg=None):
-    if len(text) > MAX_MESSAGE_LENGTH:
+# --- 8. HELPER: SAFE SENDING ---
+
+async def safe_edit_message(query, text, reply_markup):
+    """Редагує повідомлення HTML-текстом з format_markdown/format_plain (розмітка вже валідна)."""
+    await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=PARSE_MODE)
+
+def split_for_chat(text, formatter):
+    """HTML-повідомлення для тексту або None, якщо їх більше за MAX_MESSAGE_PARTS (тоді — файл)."""
+    if len(text) > MAX_MESSAGE_LENGTH * MAX_MESSAGE_PARTS:
+        return None
+    parts = formatter(text)
+    return parts if len(parts) <= MAX_MESSAGE_PARTS else None
+
+class StreamingMessage:
+    """Прогресивне оновлення повідомлення під час стрімінгу.
+
+    Редагування об'єднуються: показується лише останній накопичений текст і не
+    частіше, ніж раз на STREAM_EDIT_INTERVAL. Проміжні версії йдуть без Markdown,
+    бо незакриті зірочки ламають парсинг. Коли текст перевищує MAX_MESSAGE_LENGTH,
+    редагування припиняються — фінальну доставку (частинами або файлом) робить викликач.
+    """
+
+    def __init__(self, edit, interval=STREAM_EDIT_INTERVAL):
+        self._edit = edit
+        self._interval = interval
+        self._next_edit_at = 0.0
+        self.overflowed = False
+
+    async def update(self, text):
+        if self.overflowed or time.monotonic() < self._next_edit_at:
+            return
+        if len(text) > MAX_MESSAGE_LENGTH:
+            self.overflowed = True
+            text = "📂 Відповідь велика, зараз надішлю..."
+        else:
+            text += STREAM_CURSOR
+        self._next_edit_at = time.monotonic() + self._interval
+        try:
+            await self._edit(text)
+        except telegram.error.RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            self._next_edit_at = time.monotonic() + retry_after
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Stream Edit Error: {e}")
+
+async def send_smart_response(chat_id, text, reply_markup=None, caption_msg=None, formatter=format_plain):
+    """Надсилає текст із заголовком caption_msg; клавіатура — під останнім повідомленням.
+
+    Текст, що вміщується в MAX_MESSAGE_PARTS повідомлень, іде частинами, довший — файлом.
+    Повертає повідомлення з клавіатурою.
+    """
+    parts = split_for_chat(text, formatter)
+    if parts is None:
         file_obj = io.BytesIO(text.encode('utf-8'))
         file_obj.name = "documind_text.txt"
         
-        await bot.send_document(
+        await get_bot().send_document(
             chat_id=chat_id, 
             document=file_obj, 
             caption="📂 *Текст великий, тому я зберіг його у файл.*",
             parse_mode='Markdown'
         )
         msg_text = caption_msg if caption_msg else "✅ *Готово.* Оберіть дію:"
-        return await bot.send_message(chat_id, msg_text, reply_markup=reply_markup, parse_mode='Markdown')
-    else:
-        msg_text = caption_msg + f"\n\n`{text}`" if caption_msg else f"📄 *Текст:*\n\n`{text}`"
-        try:
-            return await bot.send_message(
-                chat_id=chat_id,
-                text=msg_text,
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-        except telegram.error.BadRequest:
-             return await bot.send_message(
-                chat_id=chat_id,
-                text=msg_text.replace('`', '').replace('*', ''),
-                reply_markup=reply_markup,
-                parse_mode=None
-            )
+        return await get_bot().send_message(chat_id, msg_text, reply_markup=reply_markup, parse_mode='Markdown')
+
+    # Заголовок короткий: MAX_MESSAGE_LENGTH лишає достатній запас до ліміту Telegram (4096)
+    parts[0] = render_markdown(caption_msg or "📄 *Текст:*") + "\n\n" + parts[0]
+    for part in parts[:-1]:
+        await get_bot().send_message(chat_id, part, parse_mode=PARSE_MODE)
+    return await get_bot().send_message(chat_id, parts[-1], reply_markup=reply_markup, parse_mode=PARSE_MODE)
 
-# --- 8. BOT HANDLERS ---
+# --- 9. BOT HANDLERS ---
 
 async def start_command(update: Update):
     welcome_text = (
@@ -282,29 +1577,28 @@ async def start_command(update: Update):
         "💬 *Режим 2: Пряма команда*\n"
         "Надішліть фото і *додайте підпис* (наприклад: _'Що тут сказано про податки?'_), і я одразу відповім на ваше питання."
     )
-    await bot.send_message(update.effective_chat.id, welcome_text, parse_mode='Markdown')
+    await get_bot().send_message(update.effective_chat.id, welcome_text, parse_mode='Markdown')
 
 async def clear_command(update: Update):
     """Очищення чату (візуальне) для нового сеансу."""
-    await bot.send_message(
+    await get_bot().send_message(
         chat_id=update.effective_chat.id,
         text="🗑️ *Історію сесії очищено.* Я готовий до нового фото!",
         parse_mode='Markdown'
     )
 
-async def process_photo_interactive(update: Update):
+async def process_photo_interactive(update: Update, messages):
     """Сценарій Б: Фото БЕЗ підпису -> Меню кнопок"""
     chat_id = update.effective_chat.id
-    status_msg = await bot.send_message(chat_id, "⏳ *Аналізую зображення...*", parse_mode='Markdown')
+    status_text = f"⏳ *Аналізую сторінки ({len(messages)})...*" if len(messages) > 1 else "⏳ *Аналізую зображення...*"
+    status_msg = await get_bot().send_message(chat_id, status_text, parse_mode='Markdown')
     
     try:
-        photo_file = await update.message.photo[-1].get_file()
-        image_bytes = await photo_file.download_as_bytearray()
-        raw_text = await real_vision_api(bytes(image_bytes))
-        await bot.delete_message(chat_id, status_msg.message_id)
+        raw_text = await recognize_pages([get_ocr_media(m) for m in messages])
+        await get_bot().delete_message(chat_id, status_msg.message_id)
         
         if not raw_text:
-            await bot.send_message(chat_id, "⚠️ *Текст не виявлено.*", parse_mode='Markdown')
+            await get_bot().send_message(chat_id, "⚠️ *Текст не виявлено.*", parse_mode='Markdown')
             return
 
         sent_msg = await send_smart_response(
@@ -313,48 +1607,50 @@ async def process_photo_interactive(update: Update):
             reply_markup=get_main_keyboard(), 
             caption_msg="✅ *Текст розпізнано!* Оберіть дію:"
         )
-        save_to_cache(chat_id, sent_msg.message_id, raw_text)
+        await save_to_cache(chat_id, sent_msg.message_id, raw_text)
+        schedule_prefetch(chat_id, sent_msg.message_id, raw_text)
 
     except Exception as e:
         logger.error(f"Error: {e}")
-        await bot.send_message(chat_id, "❌ *Помилка.*", parse_mode='Markdown')
+        await get_bot().send_message(chat_id, "❌ *Помилка.*", parse_mode='Markdown')
 
-async def process_photo_direct(update: Update):
+async def process_photo_direct(update: Update, messages, user_prompt):
     """Сценарій А: Фото З підписом -> Пряма відповідь"""
     chat_id = update.effective_chat.id
-    user_prompt = update.message.caption
     
-    status_msg = await bot.send_message(chat_id, f"🧠 *Виконую запит:* _{user_prompt}_...", parse_mode='Markdown')
+    status_msg = await get_bot().send_message(
+        chat_id, f"🧠 <b>Виконую запит:</b> <i>{escape_html(user_prompt)}</i>...", parse_mode=PARSE_MODE
+    )
     
     try:
-        # 1. OCR
-        photo_file = await update.message.photo[-1].get_file()
-        image_bytes = await photo_file.download_as_bytearray()
-        raw_text = await real_vision_api(bytes(image_bytes))
+        # 1. OCR (усі сторінки альбому)
+        raw_text = await recognize_pages([get_ocr_media(m) for m in messages])
         
         if not raw_text:
-            await bot.delete_message(chat_id, status_msg.message_id)
-            await bot.send_message(chat_id, "⚠️ *Текст не виявлено.*", parse_mode='Markdown')
+            await get_bot().delete_message(chat_id, status_msg.message_id)
+            await get_bot().send_message(chat_id, "⚠️ *Текст не виявлено.*", parse_mode='Markdown')
             return
 
-        # 2. AI з кастомним промптом
-        result_text = await real_gemini_api(raw_text, user_prompt)
-        await bot.delete_message(chat_id, status_msg.message_id)
+        # 2. AI з кастомним промптом (відповідь з'являється у статусному повідомленні по мірі генерації)
+        stream = StreamingMessage(lambda partial: status_msg.edit_text(partial))
+        result_text = await get_ai_result(raw_text, user_prompt, on_chunk=stream.update)
+        await get_bot().delete_message(chat_id, status_msg.message_id)
         
         # 3. Надсилаємо результат + КЛАВІАТУРУ ДІЙ
         sent_msg = await send_smart_response(
             chat_id,
             result_text,
             reply_markup=get_direct_response_keyboard(), # Додано кнопки "Меню" і "Нове фото"
-            caption_msg="✅ *Відповідь на ваш запит:*"
+            caption_msg="✅ *Відповідь на ваш запит:*",
+            formatter=format_markdown
         )
         
         # 4. Кешуємо текст, щоб кнопка "Всі дії" спрацювала
-        save_to_cache(chat_id, sent_msg.message_id, raw_text)
+        await save_to_cache(chat_id, sent_msg.message_id, raw_text)
         
     except Exception as e:
         logger.error(f"Direct Mode Error: {e}")
-        await bot.send_message(chat_id, "❌ *Помилка при обробці запиту.*", parse_mode='Markdown')
+        await get_bot().send_message(chat_id, "❌ *Помилка при обробці запиту.*", parse_mode='Markdown')
 
 async def process_callback(update: Update):
     query = update.callback_query
@@ -365,84 +1661,354 @@ async def process_callback(update: Update):
     await query.answer()
     
     if command == "new_scan":
+        cancel_prefetch(chat_id, message_id)
         await query.delete_message()
-        await bot.send_message(chat_id, "🗑️ *Очищено.* Чекаю нове фото!", parse_mode='Markdown')
+        await get_bot().send_message(chat_id, "🗑️ *Очищено.* Чекаю нове фото!", parse_mode='Markdown')
         return
 
-    original_text = get_from_cache(chat_id, message_id)
+    original_text = await get_from_cache(chat_id, message_id)
     if not original_text:
         await query.edit_message_text("⚠️ *Сесія застаріла.* Надішліть фото знову.", parse_mode='Markdown')
         return
 
     # Логіка повернення до меню (працює і для "back_to_menu", і для "Всі дії")
     if command == "back_to_menu":
-        if len(original_text) > MAX_MESSAGE_LENGTH:
+        parts = split_for_chat(original_text, format_plain)
+        if parts is None or len(parts) > 1:
             await query.edit_message_text(
-                "📄 *Оригінальний текст (у файлі вище)*\n\nОберіть дію:", 
+                "📄 *Оригінальний текст (вище)*\n\nОберіть дію:", 
                 reply_markup=get_main_keyboard(), 
                 parse_mode='Markdown'
             )
         else:
             await safe_edit_message(
                 query,
-                f"📄 *Оригінальний текст:*\n\n`{original_text}`", 
+                render_markdown("📄 *Оригінальний текст:*") + "\n\n" + parts[0],
                 get_main_keyboard()
             )
         return
 
-    await query.edit_message_text(f"🧠 *Gemini працює...*", parse_mode='Markdown')
-    result_text = await real_gemini_api(original_text, command)
+    progress_shown = False
+
+    async def show_progress():
+        nonlocal progress_shown
+        if not progress_shown:
+            progress_shown = True
+            await query.edit_message_text(f"🧠 *Gemini працює...*", parse_mode='Markdown')
+
+    # Якщо prefetch цієї дії ще в польоті, статус з'являється до очікування задачі
+    result_text = await take_prefetched_result(chat_id, message_id, command, on_wait=show_progress)
+    if result_text is None or result_text == AI_ERROR_MESSAGE:
+        result_text = await lookup_ai_result(original_text, command)
+    if result_text is None:
+        await show_progress()
+        stream = StreamingMessage(lambda partial: query.edit_message_text(partial))
+        result_text = await generate_ai_result(original_text, command, on_chunk=stream.update)
     
-    if len(result_text) > MAX_MESSAGE_LENGTH:
+    parts = split_for_chat(result_text, format_markdown)
+    if parts is None:
         file_obj = io.BytesIO(result_text.encode('utf-8'))
         file_obj.name = f"{command}_result.txt"
-        await bot.send_document(chat_id, file_obj, caption="🧠 *Результат (у файлі):*", parse_mode='Markdown')
+        await get_bot().send_document(chat_id, file_obj, caption="🧠 *Результат (у файлі):*", parse_mode='Markdown')
         
         await query.edit_message_text(
             "✅ *Готово!* Результат у файлі.\nЩе дії?", 
             reply_markup=get_back_keyboard(),
             parse_mode='Markdown'
         )
+    elif len(parts) > 1:
+        for part in parts:
+            await get_bot().send_message(chat_id, part, parse_mode=PARSE_MODE)
+        await query.edit_message_text(
+            "✅ *Готово!* Результат вище.\nЩе дії?", 
+            reply_markup=get_back_keyboard(),
+            parse_mode='Markdown'
+        )
     else:
         await safe_edit_message(
             query,
-            result_text,
+            parts[0],
             get_back_keyboard()
         )
 
-async def main_logic(update: Update):
+def is_album_page(message):
+    """Чи є повідомлення сторінкою альбому, яку треба розпізнати (фото або підтримуваний файл)."""
+    if message is None or not message.media_group_id:
+        return False
+    if message.document:
+        return is_supported_document(message) and not (
+            message.document.file_size and message.document.file_size > MAX_DOCUMENT_BYTES
+        )
+    return bool(message.photo)
+
+async def main_logic(update: Update, messages=None):
+    """Маршрутизація апдейта; messages — сторінки альбому, які вже зібрав handle_update."""
     if update.message:
         text = update.message.text
         if text and text.startswith('/start'):
             await start_command(update)
         elif text and text.startswith('/clear'):
             await clear_command(update)
-        elif update.message.photo:
-            if update.message.caption:
-                await process_photo_direct(update)
+        elif update.message.document and not is_supported_document(update.message):
+            await get_bot().send_message(update.effective_chat.id, "⚠️ Підтримуються файли JPEG, PNG і PDF.", parse_mode='Markdown')
+        elif update.message.document and update.message.document.file_size and update.message.document.file_size > MAX_DOCUMENT_BYTES:
+            await get_bot().send_message(update.effective_chat.id, "⚠️ *Файл завеликий* (максимум 20 МБ).", parse_mode='Markdown')
+        elif update.message.photo or update.message.document:
+            messages = messages or [update.message]
+            # Telegram прикріплює підпис альбому лише до одного з фото
+            caption = next((m.caption for m in messages if m.caption), None)
+            if caption:
+                await process_photo_direct(update, messages, caption)
             else:
-                await process_photo_interactive(update)
+                await process_photo_interactive(update, messages)
         else:
-            await bot.send_message(update.effective_chat.id, "⚠️ Надішліть фото.", parse_mode='Markdown')
+            await get_bot().send_message(update.effective_chat.id, "⚠️ Надішліть фото.", parse_mode='Markdown')
     elif update.callback_query:
         await process_callback(update)
 
+# --- 10. ADMISSION CONTROL ---
+
+class TokenBucket:
+    """Token bucket: rate токенів за секунду, не більше capacity у запасі."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.notified = False  # чи вже казали користувачу про ліміт
+
+    def try_acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.notified = False
+            return True
+        return False
+
+_seen_updates = LRUCache(DEDUP_MAX_UPDATES, ttl=DEDUP_TTL)
+_chat_buckets = LRUCache(DEDUP_MAX_UPDATES, ttl=DEDUP_TTL)
+_admitted_media_groups = LRUCache(DEDUP_MAX_UPDATES, ttl=DEDUP_TTL)
+_admission_slots = None
+_admission_queued = 0
+
+# Кнопки, які лише перемальовують меню чи чат і не звертаються до бекендів
+FREE_CALLBACKS = ("back_to_menu", "new_scan")
+
+async def needs_backend_work(update: Update):
+    """Чи запустить апдейт Vision або Gemini: нове фото/документ або дія без готової відповіді."""
+    message = update.message
+    if message is not None:
+        return bool(message.photo) or is_supported_document(message)
+    query = update.callback_query
+    if query is None or query.message is None or query.data in FREE_CALLBACKS:
+        return False
+    text = await get_from_cache(query.message.chat_id, query.message.message_id)
+    if text is None:
+        return False  # сесія застаріла — відповідь без бекендів
+    if ai_result_key(text, query.data) in _prefetch_tasks:
+        return False  # відповідь уже генерується у фоні
+    return await lookup_ai_result(text, query.data) is None
+
+async def allow_chat(update: Update):
+    """Ліміт на чат. Токени витрачають лише апдейти, що запускають Vision або Gemini;
+    сторінки альбому, що вже збирається, теж безкоштовні."""
+    message = update.message
+    if message and message.media_group_id and _admitted_media_groups.get(message.media_group_id):
+        return True
+    chat = update.effective_chat
+    if chat is None or not await needs_backend_work(update):
+        return True
+    bucket = _chat_buckets.get(chat.id)
+    if bucket is None:
+        bucket = TokenBucket(CHAT_RATE, CHAT_BURST)
+        _chat_buckets.set(chat.id, bucket)
+    if not bucket.try_acquire():
+        return False
+    if message and message.media_group_id:
+        _admitted_media_groups.set(message.media_group_id, True)
+    return True
+
+def _update_doc(update_id):
+    return get_db().collection(DEDUP_COLLECTION).document(str(update_id))
+
+def _claim_update(update_id):
+    """Атомарно бере update_id в обробку. False, якщо його вже взяв цей чи інший інстанс."""
+    from google.api_core import exceptions
+    with timed("dedup_claim"):
+        try:
+            _update_doc(update_id).create({
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=DEDUP_TTL),
+            })
+            return True
+        except exceptions.AlreadyExists:
+            return False
+
+def _release_update(update_id):
+    _update_doc(update_id).delete()
+
+async def reply_busy(update: Update, text):
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(text)
+        elif update.effective_chat:
+            await get_bot().send_message(update.effective_chat.id, text)
+    except telegram.error.TelegramError as e:
+        logger.warning(f"Busy Reply Error: {e}")
+
+def update_kind(update: Update):
+    """Тип апдейта для метрик: photo, document, album, callback:<дані кнопки>, command, text."""
+    if update.callback_query:
+        return f"callback:{update.callback_query.data}"
+    message = update.message
+    if message is None:
+        return "other"
+    if message.media_group_id:
+        return "album"
+    if message.photo:
+        return "photo_caption" if message.caption else "photo"
+    if message.document:
+        return "document"
+    if message.text and message.text.startswith("/"):
+        return "command"
+    return "text"
+
+async def handle_update(update: Update):
+    """Вхід для всіх апдейтів: дедуплікація, ліміт на чат, глобальний ліміт з чергою -> main_logic."""
+    global _admission_slots, _admission_queued
+    if _seen_updates.get(update.update_id) is not None:
+        logger.info(f"Duplicate update skipped: {update.update_id}")
+        return
+    _seen_updates.set(update.update_id, True)
+    try:
+        claimed = await run_blocking("firestore", _claim_update, update.update_id)
+    except Exception as e:
+        # Без Firestore дублікати відсікаються лише в пам'яті інстансу
+        logger.warning(f"Dedup Claim Error: {e}")
+        claimed = None
+    if claimed is False:
+        logger.info(f"Duplicate update skipped (claimed elsewhere): {update.update_id}")
+        return
+
+    try:
+        if not await allow_chat(update):
+            bucket = _chat_buckets.get(update.effective_chat.id)
+            # На натискання кнопки відповідаємо завжди, інакше в клієнті крутиться індикатор
+            if update.callback_query or not bucket.notified:
+                bucket.notified = True
+                await reply_busy(update, "⏳ Забагато запитів. Зачекайте трохи і спробуйте знову.")
+            return
+
+        # Альбом збирається до черги: власник не тримає слот, поки чекає на інші сторінки,
+        # а сторінки, що лише дописують себе в групу, слоту не потребують
+        messages = None
+        if is_album_page(update.message):
+            messages = await collect_media_group(update.message)
+            if messages is None:
+                return  # сторінку забрав перший апдейт альбому
+
+        if _admission_slots is None:
+            _admission_slots = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+        if _admission_slots.locked() and _admission_queued >= MAX_QUEUED_UPDATES:
+            await reply_busy(update, "⏳ Бот зараз перевантажений. Спробуйте за хвилину.")
+            return
+
+        _admission_queued += 1
+        try:
+            await asyncio.wait_for(_admission_slots.acquire(), ADMISSION_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            await reply_busy(update, "⏳ Бот зараз перевантажений. Спробуйте за хвилину.")
+            return
+        finally:
+            _admission_queued -= 1
+
+        try:
+            with timed("update", kind=update_kind(update)):
+                await main_logic(update, messages)
+        finally:
+            _admission_slots.release()
+    except BaseException:
+        # Збій або таймаут webhook: Telegram доставить апдейт повторно — не відкидаємо його як дубль
+        _seen_updates.pop(update.update_id)
+        if claimed:
+            try:
+                await run_blocking("firestore", _release_update, update.update_id)
+            except Exception as e:
+                logger.warning(f"Dedup Release Error: {e}")
+        raise
+
 # --- ENTRY POINT ---
+# Теплий інстанс Cloud Functions тримає один event loop у фоновому потоці.
+# Так httpx-пул бота (і TLS-з'єднання з Telegram) живе між викликами, а
+# паралельні запити з різних потоків сервера безпечно діляться одним loop.
+_runtime_loop = None
+_runtime_lock = threading.Lock()
+_bot_init_lock = None
+
+def get_runtime_loop():
+    """Довгоживучий event loop інстансу (створюється під час першого запиту)."""
+    global _runtime_loop
+    with _runtime_lock:
+        if _runtime_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="documind-loop", daemon=True).start()
+            _runtime_loop = loop
+    return _runtime_loop
+
+def run_in_runtime(coro, timeout=WEBHOOK_TIMEOUT):
+    """Виконує корутину в runtime-loop і чекає результат з потоку запиту."""
+    future = asyncio.run_coroutine_threadsafe(coro, get_runtime_loop())
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise
+
+async def ensure_bot_initialized():
+    """Одноразова ініціалізація бота (HTTP-сесія) в межах runtime-loop."""
+    global _bot_init_lock
+    if _bot_init_lock is None:
+        _bot_init_lock = asyncio.Lock()
+    async with _bot_init_lock:
+        await get_bot().initialize()  # повторний виклик нічого не робить
+
+async def process_webhook_update(payload):
+    await ensure_bot_initialized()
+    with timed("webhook_decode"):
+        update = Update.de_json(payload, get_bot())
+    try:
+        await handle_update(update)
+    finally:
+        # Відповідь користувачу вже надіслано; записи кешів комітимо до кінця HTTP-запиту,
+        # бо поза ним CPU інстансу Cloud Functions обмежується і таймер може не спрацювати
+        await cache_writes.flush()
+
 @functions_framework.http
 def telegram_webhook(request):
     if request.method != "POST": return "OK", 200
     try:
-        if bot is None: return "Bot Error", 500
-        update = Update.de_json(request.get_json(force=True), bot)
-        asyncio.run(main_logic(update))
+        get_bot()
+    except Exception as e:
+        logger.critical(f"Critical Error: {e}")
+        return "Bot Error", 500
+    try:
+        run_in_runtime(process_webhook_update(request.get_json(force=True)))
         return "OK", 200
     except Exception: return "Error", 500
 
 # --- LOCAL RUN ---
 if __name__ == "__main__":
+    from telegram.ext import ApplicationBuilder, MessageHandler, CallbackQueryHandler, filters
+    TELEGRAM_TOKEN, = get_secrets("TELEGRAM_BOT_TOKEN")
     if not TELEGRAM_TOKEN: exit(1)
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    async def h(u, c): await main_logic(u)
+    async def flush_cache_writes(application): await cache_writes.flush()
+    app = (
+        ApplicationBuilder().token(TELEGRAM_TOKEN).concurrent_updates(POLLING_CONCURRENT_UPDATES)
+        .post_shutdown(flush_cache_writes).build()
+    )
+    async def h(u, c): await handle_update(u)
     app.add_handler(MessageHandler(filters.ALL, h))
     app.add_handler(CallbackQueryHandler(h))
     app.run_polling()
\ No newline at end of file